@@ -0,0 +1,458 @@
+'''
+Non-blocking router driver for polling many routers from one thread
+
+asyncio is not available on Python 2, so this is a small select() loop
+running generator based coroutines. It speaks the vendor dialects from
+routers.py, only the transport and the waiting differ. A coroutine yields
+a Wait to block on a session, or another coroutine to call it, and raises
+Return to hand back a value:
+
+    def uptime(router):
+        output = yield router.cmd('show system uptime')
+        raise Return(output)
+
+    results = aio.poll([aio.AsyncHandle('r1.example.net', 12345)], uptime)
+'''
+
+import errno, fcntl, logging, os, pty, re, select, signal, sys, time, types
+import pexpect
+import routers, utils
+from confcache import ConfigSnapshot
+
+log = logging.getLogger(__name__)
+
+class Return(Exception):
+    '''Raised by a coroutine to return a value to its caller'''
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Wait(object):
+    '''Yielded by a coroutine to sleep until session has data or deadline passes'''
+    def __init__(self, session, deadline):
+        self.session = session
+        self.deadline = deadline
+
+#### Transports ####
+
+class ProcessTransport(object):
+    '''Run a command on a pseudo terminal, like pexpect.spawn does'''
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            try:
+                os.execvp(argv[0], argv)
+            finally:
+                os._exit(127)
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        '''Return available data, '' on EOF or None if nothing is ready'''
+        try:
+            return os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return None
+            if e.errno == errno.EIO:
+                return '' # linux signals EOF on a pty this way
+            raise
+
+    def write(self, data):
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                select.select([], [self.fd], [], 1)
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        for sig in (signal.SIGHUP, signal.SIGKILL):
+            try:
+                if os.waitpid(self.pid, os.WNOHANG)[0]:
+                    return
+                os.kill(self.pid, sig)
+                time.sleep(0.01)
+            except OSError:
+                return
+        os.waitpid(self.pid, 0)
+
+class SocketTransport(object):
+    '''Talk to a router over an already connected stream socket'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self):
+        try:
+            return self.sock.recv(65536)
+        except IOError, e:
+            if e.errno == errno.EAGAIN:
+                return None
+            raise
+
+    def write(self, data):
+        while data:
+            try:
+                data = data[self.sock.send(data):]
+            except IOError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                select.select([], [self.sock], [], 1)
+
+    def close(self):
+        self.sock.close()
+
+#### Sessions ####
+
+_compiled = {}
+
+def _compile(pattern):
+    if pattern not in _compiled:
+        _compiled[pattern] = re.compile(pattern, re.DOTALL)
+    return _compiled[pattern]
+
+class Session(object):
+    '''Buffers the output of a transport and matches it like pexpect'''
+
+    def __init__(self, transport, logger, timeout=10):
+        self.transport = transport
+        self.pipe = utils.PipeLogger(logger)
+        self.timeout = timeout
+        self.buffer = ''
+        self.eof = False
+        self.before = None
+        self.match = None
+
+    def fileno(self):
+        return self.transport.fileno()
+
+    def feed(self):
+        '''Read whatever the transport has. Called by the loop'''
+        data = self.transport.read()
+        if data is None:
+            return
+        if not data:
+            self.eof = True
+        else:
+            self.pipe.write(data)
+            self.buffer += data
+
+    def send(self, data):
+        self.transport.write(data)
+
+    def sendline(self, line=''):
+        self.send(line + '\n')
+
+    def discard(self):
+        '''Throw away unread output, without waiting for more'''
+        if select.select([self], [], [], 0)[0]:
+            self.feed()
+        self.buffer = ''
+
+    def expect(self, patterns, timeout=None):
+        '''Coroutine: wait until one of patterns matches and return its index'''
+        if not isinstance(patterns, list):
+            patterns = [ patterns ]
+        deadline = time.time() + (timeout or self.timeout)
+
+        while True:
+            best = None
+            for i, pattern in enumerate(patterns):
+                if pattern in (pexpect.EOF, pexpect.TIMEOUT):
+                    continue
+                m = _compile(pattern).search(self.buffer)
+                if m and (not best or m.start() < best[1].start()):
+                    best = (i, m)
+
+            if best:
+                i, self.match = best
+                self.before = self.buffer[:self.match.start()]
+                self.buffer = self.buffer[self.match.end():]
+                raise Return(i)
+
+            if self.eof:
+                self.before, self.buffer, self.match = self.buffer, '', pexpect.EOF
+                if pexpect.EOF in patterns:
+                    raise Return(patterns.index(pexpect.EOF))
+                raise pexpect.EOF('End Of File (EOF).')
+
+            if time.time() >= deadline:
+                self.before, self.match = self.buffer, pexpect.TIMEOUT
+                if pexpect.TIMEOUT in patterns:
+                    raise Return(patterns.index(pexpect.TIMEOUT))
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+
+            yield Wait(self, deadline)
+
+    def close(self):
+        self.transport.close()
+
+#### Routers ####
+
+class AsyncRouter(object):
+    '''Drive a vendor dialect from routers.py over a Session'''
+
+    def __init__(self, dialect, session):
+        self.dialect = dialect
+        self.session = session
+
+    def prompt(self):
+        '''Coroutine: wait for a prompt and return what comes before'''
+        yield self.session.expect(self.dialect._prompts)
+        raise Return(self.session.before)
+
+    def cmd(self, cmd):
+        '''Coroutine: run commands in one batch and return the result'''
+        lines = [ line.strip() for line in cmd.strip().splitlines() ] or [ '' ]
+        self.session.discard()
+        log.debug('typing %r', lines)
+        self.session.send(''.join(line + '\n' for line in lines))
+
+        result = []
+        for line in lines:
+            result.append((yield self.prompt()))
+
+        raise Return(''.join(result))
+
+    def connect(self):
+        if self.dialect._connect_prompt:
+            yield self.prompt()
+        for cmd in self.dialect._connect_cmds:
+            yield self.cmd(cmd)
+
+    def peers(self):
+        '''Coroutine: see routers.Router.iter_peers'''
+        dialect = self.dialect
+        while True:
+            cmd, parser = dialect._peers_cmds[dialect._peers_mode]
+            output = yield self.cmd(cmd)
+            try:
+                peers = list(parser(output.splitlines()))
+                break
+            except ValueError, e:
+                if dialect._peers_mode + 1 == len(dialect._peers_cmds):
+                    raise
+                log.info('falling back from %r: %s', cmd, e)
+                dialect._peers_mode += 1
+
+        raise Return(peers)
+
+    def hardware(self):
+        output = ''
+        if self.dialect._hardware_cmd:
+            output = yield self.cmd(self.dialect._hardware_cmd)
+        raise Return(self.dialect._parse_hardware(output))
+
+    def peer_info(self, ip):
+        dialect = self.dialect
+        info = {}
+        for key, cmd in dialect._peer_info_cmds(ip):
+            if isinstance(cmd, routers.NeighborConfig):
+                # no ConfigCache outlives a poll, filter a fresh config
+                output = yield self.cmd(dialect._config_cmd)
+                snapshot = ConfigSnapshot(output, None, dialect._config_group_re,
+                        dialect._config_context_re)
+                info[key] = routers._join(snapshot.neighbor(cmd.ip))
+            else:
+                info[key] = yield self.cmd(cmd)
+        raise Return(info)
+
+    def close(self):
+        '''Coroutine: log out politely'''
+        try:
+            self.session.sendline('exit')
+            yield self.session.expect([pexpect.EOF, pexpect.TIMEOUT], timeout=2)
+        finally:
+            self.session.close()
+
+class AsyncHandle(object):
+    '''Connection parameters of one router, see routers.RouterHandle'''
+
+    def __init__(self, host, asn, password=None, command=None, timeout=10):
+        self.host = host
+        self.asn = asn
+        self.password = password
+        self.command = command or [ 'ssh', '-oProtocol=2,1', host ]
+        self.timeout = timeout
+        self.error = None
+
+    def connect(self):
+        '''Coroutine: log in, detect the vendor and return an AsyncRouter'''
+        log.debug('connecting to %s', self.host)
+        transport = ProcessTransport(self.command)
+        session = Session(transport, logging.getLogger(self.host), self.timeout)
+        try:
+            router = yield self._login(session)
+        except Exception:
+            session.pipe.clear()
+            session.close()
+            raise
+        raise Return(router)
+
+    def _login(self, session):
+        i = yield session.expect(routers.RouterHandle._login_patterns)
+        if i == 0:
+            if not self.password:
+                raise RuntimeError('login failed: password required but not supplied')
+            session.sendline(self.password)
+            after = yield session.expect(['JUNOS'] + routers.Cisco._prompts)
+            dialect = routers.Juniper() if after == 0 else routers.Cisco()
+        elif i == 1 or i == 2:
+            dialect = routers.Quagga()
+        elif i == 3:
+            dialect = routers.Juniper()
+        else:
+            data = session.match.group() if session.match != pexpect.EOF else "NO MATCH"
+            raise RuntimeError('login failed: %s: %s' % (self.host, session.before + data))
+
+        dialect.our_asn = self.asn
+        router = AsyncRouter(dialect, session)
+        yield router.connect()
+
+        # FIXME: remove hack when all RIS machines are equal
+        if i == 2:
+            yield router.prompt()
+
+        raise Return(router)
+
+#### Loop ####
+
+class Task(object):
+    '''A stack of coroutines; the top one is running'''
+
+    def __init__(self, coroutine, done):
+        self.stack = [ coroutine ]
+        self.done = done
+        self.wait = None
+
+    def step(self, value=None, exc=None):
+        '''Run until the task waits or finishes'''
+        self.wait = None
+        while True:
+            gen = self.stack[-1]
+            try:
+                if exc:
+                    op = gen.throw(*exc)
+                else:
+                    op = gen.send(value)
+            except Return, r:
+                value, exc = r.value, None
+            except StopIteration:
+                value, exc = None, None
+            except Exception:
+                value, exc = None, sys.exc_info()
+            else:
+                if isinstance(op, types.GeneratorType):
+                    self.stack.append(op)
+                    value = None
+                elif isinstance(op, Wait):
+                    self.wait = op
+                    return
+                else:
+                    value, exc = None, (TypeError, TypeError('cannot yield %r' % op), None)
+                continue
+
+            self.stack.pop()
+            if not self.stack:
+                self.done(value, exc)
+                return
+
+class Loop(object):
+    '''Multiplex many tasks over select()'''
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine, done):
+        task = Task(coroutine, done)
+        self.tasks.append(task)
+        task.step()
+
+    def run(self):
+        '''Run until every task is finished'''
+        while True:
+            self.tasks = [ t for t in self.tasks if t.wait ]
+            if not self.tasks:
+                return
+
+            sessions = dict((t.wait.session.fileno(), t) for t in self.tasks)
+            timeout = max(0, min(t.wait.deadline for t in self.tasks) - time.time())
+            try:
+                ready = select.select(sessions.keys(), [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in ready:
+                sessions[fd].wait.session.feed()
+
+            now = time.time()
+            for task in list(self.tasks):
+                if task.wait and (task.wait.session.fileno() in ready or task.wait.deadline <= now):
+                    task.step()
+
+def collect(router):
+    '''Coroutine: what peerweb wants to know about a router'''
+    peers = yield router.peers()
+    hardware = yield router.hardware()
+    raise Return({ 'peers': peers, 'hardware': hardware })
+
+def poll(handles, func=collect, concurrency=100):
+    '''
+    Log into every handle, run the coroutine func(router) and log out again,
+    with at most concurrency routers in flight. Returns a dict mapping each
+    host to the result or the exception it failed with.
+    '''
+    loop = Loop()
+    results = {}
+    queue = list(reversed(handles))
+
+    def job(handle):
+        start = time.time()
+        router = yield handle.connect()
+        try:
+            result = yield func(router)
+        except Exception:
+            router.session.pipe.clear()
+            router.session.close()
+            raise
+        yield router.close()
+        log.info('%s: polled in %.1fs', handle.host, time.time() - start)
+        raise Return(result)
+
+    def start():
+        handle = queue.pop()
+
+        def done(value, exc):
+            if exc:
+                handle.error = exc[0].__name__
+                log.error('error polling %s: %s', handle.host, exc[1])
+                results[handle.host] = exc[1]
+            else:
+                results[handle.host] = value
+            if queue:
+                start()
+
+        loop.spawn(job(handle), done)
+
+    for i in range(min(concurrency, len(queue))):
+        start()
+    loop.run()
+
+    return results
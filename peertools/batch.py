@@ -0,0 +1,163 @@
+'''
+Add or delete many peers on many routers at once
+
+A manifest is a CSV file with a header naming the columns router, ip,
+asn, group and desc, one row per peer:
+
+    router,ip,asn,group,desc
+    rrc00.ripe.net,192.0.2.1,64500,peers,Example Networks
+    rrc00.ripe.net,2001:db8::1,64500,peers6,Example Networks
+
+addpeer needs every column filled in, delpeer router, ip and group.
+
+The changes of each router are rendered into one config, shown together
+for confirmation and committed once per router, several routers at a time.
+'''
+
+import csv, logging, netaddr, time
+from collections import OrderedDict
+from prettytable import PrettyTable
+from web_utils import fan_out
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ('router', 'ip', 'asn', 'group', 'desc')
+REQUIRED = {
+    'addpeer': ('router', 'ip', 'asn', 'group', 'desc'),
+    'delpeer': ('router', 'ip', 'group'),
+}
+
+class Change:
+    '''One peer to add to or delete from a router'''
+    def __init__(self, router, ip, asn=None, group=None, desc=None):
+        self.router = router
+        self.ip = ip
+        self.asn = asn
+        self.group = group
+        self.desc = desc
+
+def read_manifest(f, cmd='addpeer'):
+    '''Return { router: [ Change ] } in the order of the manifest, with all cmd needs'''
+    required = REQUIRED[cmd]
+    reader = csv.DictReader(f)
+    missing = set(required) - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError('manifest lacks the columns %s' % ', '.join(sorted(missing)))
+
+    changes = OrderedDict()
+    for line, row in enumerate(reader, 2):
+        row = dict((k, (v or '').strip() or None) for k, v in row.items() if k)
+        try:
+            for column in required:
+                if not row.get(column):
+                    raise ValueError('no %s' % column)
+            ip = row['ip']
+            if not (netaddr.valid_ipv4(ip, netaddr.INET_PTON) or netaddr.valid_ipv6(ip)):
+                raise ValueError('bad ip %r' % ip)
+            ip = netaddr.IPAddress(ip)
+            asn = int(row['asn']) if row.get('asn') else None
+        except ValueError, e:
+            raise ValueError('manifest line %d: %s' % (line, e))
+        changes.setdefault(row['router'], []).append(
+                Change(row['router'], ip, asn, row.get('group'), row.get('desc')))
+    return changes
+
+class Result:
+    '''What happened to the changes of one router'''
+    def __init__(self, router, changes):
+        self.router = router
+        self.changes = changes
+        self.state = 'pending'
+        self.config = None
+        self.warnings = []
+        self.error = None
+        self.seconds = 0.0
+
+class Deployment:
+    '''
+    Apply the changes of a manifest with one commit per router
+
+    cmd is addpeer or delpeer, handle(router) returns a RouterHandle.
+    '''
+    def __init__(self, changes, cmd, handle, concurrency=5, timeout=600):
+        self.cmd = cmd
+        self.handles = dict((router, handle(router)) for router in changes)
+        self.results = OrderedDict((r, Result(r, c)) for r, c in changes.items())
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def _run(self, func, results):
+        '''Call func(result, router) for results in parallel, recording failures'''
+        def run(result):
+            start = time.time()
+            try:
+                with self.handles[result.router] as router:
+                    func(result, router)
+            finally:
+                result.seconds += time.time() - start
+
+        for result, _, error in fan_out(results, run, self.concurrency, self.timeout):
+            if error:
+                log.error('%s: %s', result.router, error)
+                result.state = 'failed'
+                result.error = error
+
+    def prepare(self):
+        '''Render the config of every router and check its current peers'''
+        def prepare(result, router):
+            configured = set(p.ip for p in router.peers())
+            conf = []
+            for c in result.changes:
+                if self.cmd == 'addpeer':
+                    if str(c.ip) in configured:
+                        result.warnings.append('%s is configured already' % c.ip)
+                    conf.append(router.add_peer(c.group, c.ip, c.asn, c.desc))
+                else:
+                    if str(c.ip) not in configured:
+                        result.warnings.append('%s is not configured' % c.ip)
+                    conf.append(router.del_peer(c.group, c.ip))
+            result.config = ''.join(conf)
+            result.state = 'prepared'
+
+        self._run(prepare, self.results.values())
+
+    def diff(self):
+        '''The configs of all prepared routers as one text'''
+        out = []
+        for result in self.results.values():
+            out.append('### %s: %d peers, %s\n' % (result.router, len(result.changes), result.state))
+            for warning in result.warnings:
+                out.append('# WARNING %s\n' % warning)
+            if result.error:
+                out.append('# ERROR %s\n' % result.error)
+            if result.config:
+                out.append(result.config.rstrip() + '\n')
+            out.append('\n')
+        return ''.join(out)
+
+    def apply(self):
+        '''Commit the config of every prepared router'''
+        def apply(result, router):
+            router.apply_config(result.config)
+            result.state = 'applied'
+
+        self._run(apply, [ r for r in self.results.values() if r.state == 'prepared' ])
+
+    def skip(self):
+        for result in self.results.values():
+            if result.state == 'prepared':
+                result.state = 'skipped'
+
+    def report(self):
+        x = PrettyTable('router peers result seconds error'.split())
+        x.align = 'l'
+        for r in self.results.values():
+            x.add_row([ r.router, len(r.changes), r.state, '%.1f' % r.seconds, r.error or '' ])
+        return x
+
+    def ok(self):
+        return all(r.state == 'applied' for r in self.results.values())
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the hot paths of peertools, without real routers
+
+Parsing, the peer store, the peers table queries and refreshing a fleet
+of fake routers (see fakerouter.py) over pexpect and aio. Results can be
+saved and compared with a later run to catch regressions:
+
+    peerbench --save before.json
+    peerbench --compare before.json
+'''
+
+import argparse, json, os, sys, time
+from prettytable import PrettyTable
+import aio, fakerouter, parsers, utils
+from routers import RouterHandle
+from web_utils import PeerStore, RouterData, Snapshot, fan_out
+
+FAKEROUTER = os.path.splitext(fakerouter.__file__)[0] + '.py'
+VENDORS = [ 'juniper', 'cisco', 'quagga' ]
+
+def best_of(func, repeat=3):
+    '''Return the fastest of repeat runs in seconds'''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    return max(best, 1e-9)
+
+def bench_parsers(count, results):
+    '''Records parsed per second by each parser'''
+    table = fakerouter.Table(count)
+    cases = [
+        ('cisco text', parsers.cisco_summary, table.cisco(4) + table.cisco(6)),
+        ('junos xml', parsers.junos_summary_xml, table.junos()),
+        ('frr json', parsers.frr_summary_json, table.frr_json((4, 6))),
+        ('nxos json', parsers.nxos_summary_json, table.nxos_json((4, 6))),
+    ]
+
+    x = PrettyTable('parser records records/s'.split())
+    x.align = 'r'
+    for name, parser, output in cases:
+        lines = output.splitlines()
+        records = len(list(parser(lines)))
+        took = best_of(lambda: list(parser(lines)))
+        results['parse %s records/s' % name] = records / took
+        x.add_row([name, records, '%.0f' % (records / took)])
+    return x
+
+class LegacyPeer:
+    '''utils.Peer before it had slots'''
+    pass
+
+def _size(peers):
+    '''Bytes held by the records themselves, values shared between them excluded'''
+    size = 0
+    for peer in peers:
+        size += sys.getsizeof(peer)
+        if hasattr(peer, '__dict__'):
+            size += sys.getsizeof(peer.__dict__)
+    return size
+
+def bench_store(count, routers, results):
+    '''Memory and serialisation of the peers of routers with count sessions each'''
+    table = fakerouter.Table(count)
+    output = (table.cisco(4) + table.cisco(6)).splitlines()
+
+    legacy = {}
+    store = PeerStore()
+    for i in range(routers):
+        name = 'router%d' % i
+        peers = list(parsers.cisco_summary(output))
+        store.replace(name, peers)
+        legacy[name] = []
+        for peer in parsers.cisco_summary(output):
+            old = LegacyPeer()
+            old.__dict__.update(peer._json(), router=name)
+            legacy[name].append(old)
+
+    def legacy_encode():
+        peers = []
+        for name in sorted(legacy):
+            peers += legacy[name]
+        return json.dumps({ 'data': peers }, default=lambda o: o.__dict__, indent=4)
+
+    def store_encode():
+        return utils.encode({ 'data': store.all() }, indent=None)
+
+    names = sorted(legacy)
+    def snapshot_encode():
+        # what /api/peers costs after every router was refreshed once
+        snapshot = Snapshot()
+        for name in names:
+            snapshot.update(name, store.get(name))
+        return snapshot.render(names)
+
+    x = PrettyTable('path records bytes/record KB/10k encode/s'.split())
+    x.align = 'r'
+    for name, peers, encode in [
+            ('__dict__ lists', sum(legacy.values(), []), legacy_encode),
+            ('slotted store', store.all(), store_encode),
+            ('snapshot', store.all(), snapshot_encode),
+            ]:
+        took = best_of(encode)
+        size = _size(peers) / len(peers)
+        results['store %s encode records/s' % name] = len(peers) / took
+        results['store %s bytes/record' % name] = size
+        x.add_row([name, len(peers), size, size * 10000 / 1024, '%.0f' % (len(peers) / took)])
+    return x
+
+def bench_query(count, routers, results):
+    '''Milliseconds per page of the server-side peers table'''
+    table = fakerouter.Table(count)
+    output = (table.cisco(4) + table.cisco(6)).splitlines()
+    store = PeerStore()
+    names = [ 'router%d' % i for i in range(routers) ]
+    for name in names:
+        store.replace(name, list(parsers.cisco_summary(output)))
+
+    x = PrettyTable('query matched ms'.split())
+    x.align = 'r'
+    for search, sort in [
+            ('', None),
+            ('', 'ip'),
+            ('AS64600', None),
+            ('10.0.1.0/24', None),
+            ('router1 idle', 'asn'),
+            ('active', 'asn'),
+            ]:
+        query = lambda: store.query(names, search, sort=sort, length=25)
+        matched = query()[1]
+        took = best_of(lambda: [ query() for i in range(100) ]) / 100
+        name = ' '.join([search, sort and 'by ' + sort or '']).strip() or 'all'
+        results['query %s ms' % name] = took * 1000
+        x.add_row([name, matched, '%.3f' % (took * 1000)])
+    return x
+
+def fake_command(i, vendor, count, latency):
+    return [ sys.executable, FAKEROUTER, '--vendor', vendor, '--peers', str(count),
+            '--latency', str(latency), '--seed', str(i) ]
+
+def bench_fleet(routers, count, latency, concurrency, results):
+    '''Refresh a fleet of fake routers of every vendor with threads and with aio'''
+    x = PrettyTable('driver routers sessions seconds sessions/s failed'.split())
+    x.align = 'r'
+
+    store = PeerStore()
+    fleet = []
+    for i in range(routers):
+        vendor = VENDORS[i % len(VENDORS)]
+        handle = RouterHandle('%s%d' % (vendor, i), 64496, 'secret',
+                command=fake_command(i, vendor, count, latency))
+        fleet.append(RouterData(handle, store))
+
+    start = time.time()
+    failed = [ r for r, ok, error in fan_out(fleet, RouterData.refresh,
+            concurrency, timeout=600) if error or not ok ]
+    took = time.time() - start
+    for router in fleet:
+        router.handle.close()
+    results['fleet threads seconds'] = took
+    x.add_row(['threads', routers, len(store), '%.2f' % took, '%.0f' % (len(store) / took), len(failed)])
+
+    handles = [ aio.AsyncHandle('%s%d' % (VENDORS[i % len(VENDORS)], i), 64496, 'secret',
+            command=fake_command(i, VENDORS[i % len(VENDORS)], count, latency))
+            for i in range(routers) ]
+    start = time.time()
+    polled = aio.poll(handles, concurrency=concurrency)
+    took = time.time() - start
+    sessions = sum(len(r['peers']) for r in polled.values() if isinstance(r, dict))
+    failed = [ h for h, r in polled.items() if not isinstance(r, dict) ]
+    results['fleet aio seconds'] = took
+    x.add_row(['aio', routers, sessions, '%.2f' % took, '%.0f' % (sessions / took), len(failed)])
+    return x
+
+def _better(key):
+    '''Whether a higher value of a result is an improvement'''
+    return key.endswith('/s')
+
+def compare(results, baseline, tolerance):
+    '''Table of the results against a baseline, and the keys which regressed'''
+    x = PrettyTable('result baseline now change'.split())
+    x.align = 'r'
+    x.align['result'] = 'l'
+    regressed = []
+    for key in sorted(results):
+        if key not in baseline or not baseline[key]:
+            continue
+        change = results[key] / baseline[key] - 1
+        worse = -change if _better(key) else change
+        if worse > tolerance:
+            regressed.append(key)
+        x.add_row([key, '%.4g' % baseline[key], '%.4g' % results[key],
+            '%+.0f%%%s' % (change * 100, ' !' if worse > tolerance else '')])
+    return x, regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--peers', type=int, default=10000, help='sessions per router')
+    parser.add_argument('--routers', type=int, default=10, help='routers in the peer store')
+    parser.add_argument('--fleet', type=int, default=12, help='fake routers to refresh')
+    parser.add_argument('--fleet-peers', type=int, default=1000, help='sessions per fake router')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before each answer')
+    parser.add_argument('--concurrency', type=int, default=8, help='routers refreshed at once')
+    parser.add_argument('--only', action='append', choices=[ 'parse', 'store', 'query', 'fleet' ])
+    parser.add_argument('--save', metavar='FILE', help='write the results as json')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved before')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='change counted as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    only = args.only or [ 'parse', 'store', 'query', 'fleet' ]
+    if 'parse' in only:
+        print bench_parsers(args.peers, results)
+    if 'store' in only:
+        print bench_store(args.peers, args.routers, results)
+    if 'query' in only:
+        print bench_query(args.peers, args.routers, results)
+    if 'fleet' in only:
+        print bench_fleet(args.fleet, args.fleet_peers, args.latency, args.concurrency, results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            table, regressed = compare(results, json.load(f), args.tolerance)
+        print table
+        if regressed:
+            print 'regressed: %s' % ', '.join(regressed)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
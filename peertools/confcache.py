@@ -0,0 +1,179 @@
+'''
+Snapshots of the configuration of a router, searched locally
+
+The full configuration is fetched once and indexed by the addresses and
+peer groups in it, so peer_info and groups answer without asking the
+router to dump and filter it again. Before a snapshot is used, routers
+with a cheap way to tell their config revision are asked for it; the
+others have their snapshot fetched again after a while. Applying a config
+drops the snapshot.
+
+Snapshots can be kept in a directory, so short lived peercli runs share
+them as long as the revision did not change.
+'''
+
+import gzip, hashlib, json, logging, netaddr, os, re, tempfile, threading, time
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# anything which could be an address, checked by netaddr
+_address = re.compile(r'(?<![\w:.])([0-9a-fA-F]*[:.][0-9a-fA-F:.]*[0-9a-fA-F])(?![\w:])')
+
+def _ip(token):
+    if netaddr.valid_ipv4(token, netaddr.INET_PTON) or netaddr.valid_ipv6(token):
+        return str(netaddr.IPAddress(token))
+    return None
+
+class ConfigSnapshot:
+    '''
+    The configuration of a router with the lines mentioning each address
+    and defining each peer group
+
+    group_re matches the lines defining a group as its first group,
+    context_re lines always shown with those of an address.
+    '''
+    def __init__(self, text, revision=None, group_re=None, context_re=None, fetched=None):
+        self.text = text
+        self.revision = revision
+        self.fingerprint = hashlib.sha1(text).hexdigest()
+        self.fetched = fetched or time.time()
+        self.lines = text.splitlines()
+        self._addresses = {} # address -> [ line number ]
+        self._groups = OrderedDict() # group -> [ line number ]
+        self._context = []
+
+        group_re = group_re and re.compile(group_re)
+        context_re = context_re and re.compile(context_re)
+        known = {} # token -> address or None, configs repeat addresses a lot
+        for i, line in enumerate(self.lines):
+            for token in _address.findall(line):
+                ip = known.get(token, False)
+                if ip is False:
+                    ip = known[token] = _ip(token)
+                if ip:
+                    lines = self._addresses.setdefault(ip, [])
+                    if not lines or lines[-1] != i:
+                        lines.append(i)
+            m = group_re and group_re.search(line)
+            if m:
+                self._groups.setdefault(m.group(1), []).append(i)
+            if context_re and context_re.search(line):
+                self._context.append(i)
+
+    def neighbor(self, ip):
+        '''The lines mentioning ip, with the context lines, in config order'''
+        numbers = set(self._addresses.get(_ip(str(ip)), ()))
+        if not numbers:
+            return []
+        return [ self.lines[i] for i in sorted(numbers.union(self._context)) ]
+
+    def groups(self):
+        return self._groups.keys()
+
+    def group(self, name):
+        return [ self.lines[i] for i in self._groups.get(name, ()) ]
+
+class ConfigCache:
+    '''The ConfigSnapshot of one router, fetched again when it changed'''
+
+    def __init__(self, host, path=None, ttl=300, recheck=5):
+        self.host = host
+        self.path = path # directory to keep snapshots in
+        self.ttl = ttl # seconds a snapshot lives without a revision to check
+        self.recheck = recheck # seconds a revision check is trusted
+        self.snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._busy = None # Event of the session checking or fetching
+        self._generation = 0 # bumped by invalidate()
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, router):
+        '''
+        The snapshot of the router a session of which is router
+
+        One session at a time talks to the router, the others wait for
+        its result without holding the lock.
+        '''
+        while True:
+            with self._lock:
+                now = time.time()
+                if self.snapshot is None and self.path:
+                    self.snapshot = self._load(router)
+                snapshot = self.snapshot
+                if snapshot and now - self._checked < self.recheck:
+                    return snapshot
+                if snapshot and not router._config_revision_cmd and now - snapshot.fetched < self.ttl:
+                    return snapshot
+                if self._busy is None:
+                    busy = self._busy = threading.Event()
+                    generation = self._generation
+                    break
+                busy = self._busy
+            busy.wait()
+
+        try:
+            return self._fetch(router, snapshot, generation)
+        finally:
+            with self._lock:
+                self._busy = None
+            busy.set()
+
+    def _fetch(self, router, snapshot, generation):
+        revision = None
+        if router._config_revision_cmd:
+            revision = router.cmd(router._config_revision_cmd).strip()
+            if snapshot and snapshot.revision == revision:
+                with self._lock:
+                    self._checked = time.time()
+                return snapshot
+
+        log.info('%s: fetching the configuration', self.host)
+        snapshot = ConfigSnapshot(router.cmd(router._config_cmd), revision,
+                router._config_group_re, router._config_context_re)
+        with self._lock:
+            if generation != self._generation:
+                # applied meanwhile, good for this caller only
+                return snapshot
+            self.snapshot = snapshot
+            self._checked = time.time()
+            if self.path:
+                self._save(snapshot)
+        return snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self.snapshot = None
+            self._generation += 1
+            if self.path and os.path.exists(self._file()):
+                os.unlink(self._file())
+
+    def _file(self):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', self.host) + '.conf.gz')
+
+    def _save(self, snapshot):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.' + os.path.basename(self._file()))
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0) as f:
+                    f.write(json.dumps({ 'revision': snapshot.revision,
+                        'fetched': snapshot.fetched, 'text': snapshot.text }))
+            os.rename(tmp, self._file())
+        except Exception:
+            os.unlink(tmp)
+            log.warn('cannot keep the configuration of %s', self.host, exc_info=True)
+
+    def _load(self, router):
+        try:
+            with gzip.open(self._file(), 'rb') as f:
+                doc = json.loads(f.read())
+        except IOError:
+            return None
+        except ValueError, e:
+            log.warn('ignoring broken configuration of %s: %s', self.host, e)
+            return None
+        return ConfigSnapshot(doc['text'].encode('utf-8'), doc['revision'], router._config_group_re,
+                router._config_context_re, doc['fetched'])
@@ -0,0 +1,163 @@
+'''
+Events derived from successive refreshes of a router
+
+The peers of two refreshes are compared keyed by (ip, afi, safi) and each
+difference becomes an Event: a session going down or coming up, flapping
+in between, its prefix count jumping, or a neighbor being added or
+removed. Events are kept in a bounded EventLog and handed to its sinks,
+e.g. syslog or a file.
+'''
+
+import itertools, json, logging, logging.handlers, threading, time
+
+from collections import deque
+from history import uptime_seconds
+
+log = logging.getLogger(__name__)
+
+SESSION_DOWN = 'session-down'
+SESSION_UP = 'session-up'
+SESSION_FLAP = 'session-flap'
+PREFIX_DELTA = 'prefix-delta'
+NEIGHBOR_ADDED = 'neighbor-added'
+NEIGHBOR_REMOVED = 'neighbor-removed'
+
+class Event(object):
+    '''Something which happened to one session'''
+    __slots__ = ('id', 'time', 'type', 'router', 'ip', 'afi', 'safi', 'asn', 'old', 'new')
+
+    def __init__(self, type, router, peer, old=None, new=None):
+        self.id = None # assigned by the EventLog
+        self.time = time.time() * 1000
+        self.type = type
+        self.router = router
+        self.ip = peer.ip
+        self.afi = peer.afi
+        self.safi = peer.safi
+        self.asn = peer.asn
+        self.old = old
+        self.new = new
+
+    def _json(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __str__(self):
+        text = '%s %s %s AS%s %s/%s' % (self.type, self.router, self.ip, self.asn,
+                self.afi, self.safi)
+        if self.old is not None or self.new is not None:
+            text += ' %s -> %s' % (self.old, self.new)
+        return text
+
+def _established(peer):
+    return peer.state == 'Established'
+
+def diff(router, old, new, prefix_delta=100):
+    '''Return the events between two lists of peers of router'''
+    events = []
+    before = {}
+    for peer in old:
+        before[(peer.ip, peer.afi, peer.safi)] = peer
+
+    for peer in new:
+        was = before.pop((peer.ip, peer.afi, peer.safi), None)
+        if was is None:
+            events.append(Event(NEIGHBOR_ADDED, router, peer, new=peer.state))
+        elif _established(was) and not _established(peer):
+            events.append(Event(SESSION_DOWN, router, peer, was.state, peer.state))
+        elif not _established(was) and _established(peer):
+            events.append(Event(SESSION_UP, router, peer, was.state, peer.state))
+        elif _established(peer):
+            up_before, up_now = None, None
+            if was.last_change != peer.last_change:
+                up_before = uptime_seconds(was.last_change)
+                up_now = uptime_seconds(peer.last_change)
+            if up_before is not None and up_now is not None and up_now < up_before:
+                events.append(Event(SESSION_FLAP, router, peer, was.last_change, peer.last_change))
+            elif (prefix_delta and was.prefixes is not None and peer.prefixes is not None
+                    and abs(peer.prefixes - was.prefixes) >= prefix_delta):
+                events.append(Event(PREFIX_DELTA, router, peer, was.prefixes, peer.prefixes))
+
+    for peer in before.values():
+        events.append(Event(NEIGHBOR_REMOVED, router, peer, old=peer.state))
+    return events
+
+class EventLog:
+    '''The most recent events in memory, passed on to each sink as well'''
+
+    def __init__(self, size=10000, sinks=None):
+        self._events = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.sinks = list(sinks or [])
+
+    def publish(self, events):
+        with self._lock:
+            for event in events:
+                event.id = next(self._ids)
+                self._events.append(event)
+
+        for sink in self.sinks:
+            try:
+                sink(events)
+            except Exception:
+                log.error('error writing events to %r', sink, exc_info=True)
+
+    def recent(self, limit=100, type=None, router=None, asn=None, since=None):
+        '''Events newest first, optionally only those after the id since'''
+        with self._lock:
+            events = list(self._events)
+
+        result = []
+        for event in reversed(events):
+            if since is not None and event.id <= since or len(result) >= limit:
+                break
+            if ((type is None or event.type == type) and
+                    (router is None or event.router == router) and
+                    (asn is None or event.asn == asn)):
+                result.append(event)
+        return result
+
+#### Sinks ####
+
+class SyslogSink:
+    '''Log each event as a line to syslog'''
+    def __init__(self, address='/dev/log', facility='daemon'):
+        self.handler = logging.handlers.SysLogHandler(address, facility)
+        self.handler.setFormatter(logging.Formatter('peertools: %(message)s'))
+
+    def __call__(self, events):
+        for event in events:
+            level = logging.WARNING if event.type in (SESSION_DOWN, SESSION_FLAP) else logging.INFO
+            self.handler.emit(logging.makeLogRecord({ 'msg': str(event), 'levelno': level,
+                'levelname': logging.getLevelName(level) }))
+
+    def __repr__(self):
+        return '<SyslogSink>'
+
+class FileSink:
+    '''Append each event as a line of JSON to a file'''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, events):
+        if not events:
+            return
+        lines = ''.join(json.dumps(e._json(), separators=(',', ':')) + '\n' for e in events)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+
+    def __repr__(self):
+        return '<FileSink %s>' % self.path
+
+def make_sink(spec):
+    '''A sink from config: "syslog", "syslog:<address>", "file:<path>" or a callable'''
+    if callable(spec):
+        return spec
+    kind, _, arg = spec.partition(':')
+    if kind == 'syslog':
+        return SyslogSink(arg or '/dev/log')
+    if kind == 'file' and arg:
+        return FileSink(arg)
+    raise ValueError('unknown event sink: %r' % spec)
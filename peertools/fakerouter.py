@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+'''
+A fake router speaking the Juniper, Cisco or Quagga prompt dialect
+
+Reads commands on stdin and answers the subset used by routers.py, with
+a generated BGP table. Useful for testing and benchmarking without real
+hardware, e.g.:
+
+    python fakerouter.py --vendor cisco --peers 500 --latency 0.05
+'''
+
+import argparse, json, os, random, re, sys, termios, time
+
+HOSTNAME = 'fake'
+
+JUNOS_BANNER = '--- JUNOS 12.3R6.6 built 2014-03-13 06:57:37 UTC\n'
+QUAGGA_BANNER = 'Last login: Mon Mar  3 10:00:00 2014 from gw.example.net\n'
+
+CISCO_SUMMARY_HEADER = '''BGP router identifier 192.0.2.1, local AS number 64496
+BGP table version is 1234, main routing table version 1234
+
+Neighbor        V           AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd
+'''
+
+class Table:
+    '''A deterministic set of BGP sessions'''
+    def __init__(self, count, seed=0):
+        rnd = random.Random(seed)
+        self.peers = []
+        for i in range(count):
+            v6 = i % 4 == 3
+            if v6:
+                ip = '2001:db8::%x' % (i + 1)
+            else:
+                ip = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+            up = rnd.random() > 0.1
+            self.peers.append({
+                'ip': ip,
+                'ver': 6 if v6 else 4,
+                'asn': 64512 + i % 1000,
+                'state': 'Established' if up else rnd.choice(['Active', 'Idle', 'Connect']),
+                'prefixes': rnd.randint(0, 5000) if up else None,
+                'uptime': '%dw%dd' % (rnd.randint(0, 50), rnd.randint(0, 6)),
+            })
+
+    def cisco(self, ver=4):
+        lines = [ CISCO_SUMMARY_HEADER ]
+        for p in self.peers:
+            if p['ver'] != ver:
+                continue
+            last = p['prefixes'] if p['prefixes'] is not None else p['state']
+            ip = p['ip']
+            if len(ip) > 15:
+                # long addresses get a line of their own
+                lines.append(ip + '\n')
+                ip = ''
+            lines.append('%-15s 4 %12d %7d %7d %8d %4d %4d %-8s %8s\n' % (
+                ip, p['asn'], 1000, 1000, 0, 0, 0, p['uptime'], last))
+        return ''.join(lines)
+
+    def frr_json(self, vers=(4,)):
+        doc = {}
+        for ver in vers:
+            peers = {}
+            for p in self.peers:
+                if p['ver'] == ver:
+                    peers[p['ip']] = {
+                        'remoteAs': p['asn'],
+                        'version': 4,
+                        'peerUptime': p['uptime'],
+                        'state': p['state'],
+                    }
+                    if p['prefixes'] is not None:
+                        peers[p['ip']]['pfxRcd'] = p['prefixes']
+            doc['ipv%dUnicast' % ver] = { 'as': 64496, 'peers': peers }
+        if len(vers) == 1:
+            doc = doc.values()[0]
+        return json.dumps(doc, indent=2) + '\n'
+
+    def nxos_json(self, vers=(4,)):
+        afs = []
+        for ver in vers:
+            rows = [ {
+                'neighborid': p['ip'],
+                'neighboras': str(p['asn']),
+                'time': p['uptime'],
+                'state': p['state'],
+                'prefixreceived': str(p['prefixes'] or 0),
+            } for p in self.peers if p['ver'] == ver ]
+            saf = { 'safi': '1', 'TABLE_neighbor': { 'ROW_neighbor': rows } }
+            afs.append({ 'af-id': '1' if ver == 4 else '2', 'TABLE_saf': { 'ROW_saf': saf } })
+        vrf = { 'vrf-name-out': 'default', 'TABLE_af': { 'ROW_af': afs } }
+        return json.dumps({ 'TABLE_vrf': { 'ROW_vrf': vrf } }) + '\n'
+
+    def junos(self):
+        out = [
+            '<rpc-reply xmlns:junos="http://xml.juniper.net/junos/12.3R6/junos">\n',
+            '    <bgp-information xmlns="http://xml.juniper.net/junos/12.3R6/junos-routing">\n',
+        ]
+        for p in self.peers:
+            out.append('        <bgp-peer junos:style="terse">\n')
+            out.append('            <peer-address>%s</peer-address>\n' % p['ip'])
+            out.append('            <peer-as>%d</peer-as>\n' % p['asn'])
+            out.append('            <peer-state>%s</peer-state>\n' % p['state'])
+            out.append('            <elapsed-time>%s</elapsed-time>\n' % p['uptime'])
+            if p['prefixes'] is not None:
+                out.append('            <bgp-rib>\n')
+                out.append('                <name>%s</name>\n' % ('inet6.0' if p['ver'] == 6 else 'inet.0'))
+                out.append('                <received-prefix-count>%d</received-prefix-count>\n' % p['prefixes'])
+                out.append('            </bgp-rib>\n')
+            out.append('        </bgp-peer>\n')
+        out.append('    </bgp-information>\n')
+        out.append('    <cli>\n        <banner></banner>\n    </cli>\n')
+        out.append('</rpc-reply>\n')
+        return ''.join(out)
+
+    def junos_set(self):
+        out = [
+            'set system host-name %s\n' % HOSTNAME,
+            'set protocols bgp group peers type external\n',
+            'set protocols bgp group peers6 type external\n',
+        ]
+        for p in self.peers:
+            prefix = 'set protocols bgp group %s neighbor %s ' % ('peers6' if p['ver'] == 6 else 'peers', p['ip'])
+            out.append(prefix + 'description "AS%d"\n' % p['asn'])
+            out.append(prefix + 'peer-as %d\n' % p['asn'])
+        return ''.join(out)
+
+class FakeRouter:
+    def __init__(self, table, latency=0, password=None, structured=False):
+        self.table = table
+        self.latency = latency
+        self.password = password
+        self.structured = structured # NX-OS or FRR instead of IOS or Quagga
+        self.running = True
+
+    def write(self, data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
+
+    def readline(self):
+        line = sys.stdin.readline()
+        if not line:
+            self.running = False
+        return line.strip()
+
+    def read_password(self):
+        self.write('Password:')
+        tty = sys.stdin.isatty()
+        if tty:
+            old = termios.tcgetattr(sys.stdin)
+            new = termios.tcgetattr(sys.stdin)
+            new[3] &= ~termios.ECHO
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, new)
+        try:
+            password = self.readline()
+        finally:
+            if tty:
+                termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old)
+        self.write('\n')
+        return password
+
+    def run(self):
+        self.login()
+        while self.running:
+            self.write(self.prompt())
+            line = self.readline()
+            if not self.running:
+                break
+            if self.latency:
+                time.sleep(self.latency)
+            self.write(self.answer(line))
+
+    def answer(self, line):
+        if line in ('exit', 'quit', '~.'):
+            self.running = False
+        return ''
+
+class Juniper(FakeRouter):
+    def __init__(self, *a, **kw):
+        FakeRouter.__init__(self, *a, **kw)
+        self.mode = '>'
+        self.commits = 0
+
+    def login(self):
+        self.write(JUNOS_BANNER)
+
+    def prompt(self):
+        return '\nrancid@%s%s ' % (HOSTNAME, self.mode)
+
+    def answer(self, line):
+        if line.startswith('show bgp summary'):
+            return self.table.junos()
+        elif line.startswith('show chassis hardware'):
+            return ('Hardware inventory:\n'
+                'Item             Version  Part number  Serial number     Description\n'
+                'Chassis                                J8025             M7I\n'
+                'Midplane         REV 06   710-008761   AABH6555          M7i Midplane\n')
+        elif line.startswith('ping'):
+            return 'PING: 1 packets transmitted, 1 packets received, 0% packet loss\n'
+        elif line == 'show configuration | display set':
+            return self.table.junos_set()
+        elif line.startswith('show system commit'):
+            return '0   2014-03-13 07:%02d:00 UTC by rancid via cli\n' % self.commits
+        elif line == 'conf':
+            self.mode = '#'
+            return 'Entering configuration mode\n'
+        elif line == 'commit and-quit':
+            self.mode = '>'
+            self.commits += 1
+            return 'commit complete\nExiting configuration mode\n'
+        elif line == 'exit' and self.mode == '#':
+            self.mode = '>'
+            return ''
+        return FakeRouter.answer(self, line)
+
+class Cisco(FakeRouter):
+    def login(self):
+        if self.read_password() != self.password:
+            self.write('Permission denied\n')
+            sys.exit(1)
+
+    def prompt(self):
+        return '\n%s#' % HOSTNAME
+
+    def answer(self, line):
+        if line.endswith('| json'):
+            if not self.structured:
+                return "% Invalid input detected at '^' marker.\n"
+            if ' all ' in line:
+                return self.table.nxos_json((4, 6))
+            return self.table.nxos_json((4 if ' ip ' in line else 6,))
+        elif line.startswith('show bgp all summary'):
+            return ('For address family: IPv4 Unicast\n' + self.table.cisco(4) +
+                '\nFor address family: IPv6 Unicast\n' + self.table.cisco(6))
+        elif line.startswith('show ip bgp summary'):
+            return self.table.cisco(4)
+        elif line.startswith('show bgp ipv6 unicast summary'):
+            return self.table.cisco(6)
+        elif line.startswith('show inventory'):
+            return ('NAME: "Chassis", DESCR: "Cisco 7301 single-slot chassis"\n'
+                'PID: CISCO7301         , VID:    , SN: 74852456\n')
+        elif line.startswith('ping'):
+            return 'Success rate is 100 percent (1/1), round-trip min/avg/max = 1/1/1 ms\n'
+        return FakeRouter.answer(self, line)
+
+class Quagga(FakeRouter):
+    def login(self):
+        self.write(QUAGGA_BANNER)
+
+    def prompt(self):
+        return '\n[root@%s ~]# ' % HOSTNAME
+
+    def answer(self, line):
+        if line.startswith('vtysh'):
+            out = []
+            for cmd in re.findall('-c "([^"]+)"', line):
+                ver = 6 if 'ipv6' in cmd else 4
+                if cmd.endswith('json') and not self.structured:
+                    out.append('% Unknown command.\n')
+                elif cmd.endswith('json'):
+                    out.append(self.table.frr_json((ver,)))
+                elif 'summary' in cmd:
+                    out.append(self.table.cisco(ver))
+            return ''.join(out)
+        elif line.startswith('ping'):
+            return '1 packets transmitted, 1 received, 0% packet loss, time 0ms\n'
+        return FakeRouter.answer(self, line)
+
+VENDORS = {
+    'juniper': Juniper,
+    'cisco': Cisco,
+    'quagga': Quagga,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vendor', choices=sorted(VENDORS), default='juniper')
+    parser.add_argument('--peers', type=int, default=10, help='number of BGP sessions')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each answer')
+    parser.add_argument('--password', default='secret', help='cisco login password')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='behave like NX-OS or FRR')
+    parser.add_argument('--master', help='file standing for an ssh master: '
+            'no cisco login once it exists, created by the first one')
+    args = parser.parse_args()
+
+    router = VENDORS[args.vendor](Table(args.peers, args.seed), args.latency,
+            args.password, args.json)
+    if args.master:
+        if os.path.exists(args.master):
+            router.login = lambda: None
+        else:
+            open(args.master, 'w').close()
+    try:
+        router.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
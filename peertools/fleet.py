@@ -0,0 +1,78 @@
+'''
+Run a read-only peercli command on many routers at once
+
+The routers are the configured ones matching a regex, or a list of hosts.
+Each result carries the host, the seconds it took and the error if any,
+and is yielded as soon as its router answers.
+'''
+
+import logging, re, time
+from prettytable import PrettyTable
+from routers import RouterHandle
+from web_utils import fan_out
+import config
+
+log = logging.getLogger(__name__)
+
+COMMANDS = ('peers', 'hardware', 'peerinfo')
+
+def select(pattern=None, hosts=None, asn=None, password=None):
+    '''RouterHandles of the configured routers matching pattern, and of hosts'''
+    handles = [ RouterHandle(*r) for r in config.ROUTERS
+            if pattern is not None and re.search(pattern, r[0]) ]
+    handles += [ RouterHandle(host, asn, password) for host in hosts or [] ]
+    return handles
+
+def run(handles, cmd, ip=None, concurrency=10, timeout=300):
+    '''Yield a result dict per router in the order they finish'''
+    def call(handle):
+        with handle as router:
+            if cmd == 'peers':
+                return router.peers()
+            elif cmd == 'hardware':
+                return router.hardware()
+            elif cmd == 'peerinfo':
+                return router.peer_info(ip)
+            raise RuntimeError('unknown command: %s' % cmd)
+
+    started = {}
+    def timed(handle):
+        started[handle] = time.time()
+        try:
+            return call(handle)
+        finally:
+            handle.close()
+
+    for handle, result, error in fan_out(handles, timed, concurrency, timeout):
+        yield {
+            'host': handle.host,
+            'seconds': round(time.time() - started.get(handle, time.time()), 3),
+            'error': error,
+            'result': result,
+        }
+
+def table(cmd, results):
+    '''The results as a PrettyTable, failed routers last'''
+    if cmd == 'peers':
+        x = PrettyTable('host ip asn state prefixes last_change'.split())
+        for r in results:
+            for p in r['result'] or []:
+                x.add_row([ r['host'], p.ip, p.asn, p.state, p.prefixes, p.last_change ])
+    elif cmd == 'hardware':
+        x = PrettyTable('host vendor model serial'.split())
+        for r in results:
+            if r['result']:
+                hw = r['result']
+                x.add_row([ r['host'], hw['vendor'], hw['model'], hw['serial'] ])
+    else:
+        x = PrettyTable('host key output'.split())
+        for r in results:
+            for key, output in sorted((r['result'] or {}).items()):
+                x.add_row([ r['host'], key, output.strip() ])
+    x.align = 'l'
+
+    timing = PrettyTable('host seconds error'.split())
+    timing.align = 'l'
+    for r in sorted(results, key=lambda r: (r['error'] is not None, r['host'])):
+        timing.add_row([ r['host'], '%.1f' % r['seconds'], r['error'] or '' ])
+    return '%s\n%s' % (x, timing)
@@ -0,0 +1,174 @@
+'''
+History of BGP sessions in a local SQLite file
+
+Every refresh is compared with the last known state of each session and
+only the sessions which changed are stored: a new state, a different
+prefix count or an uptime which started over. Rows older than the
+retention period are deleted.
+
+    history = History('/var/lib/peertools/history.db')
+    history.record('rrc00', peers)
+    history.peer('rrc00', '192.0.2.1')
+'''
+
+import logging, re, sqlite3, threading, time
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS peer_history (
+    time INTEGER NOT NULL,      -- unix time of the refresh
+    router TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    afi TEXT,
+    safi TEXT,
+    asn INTEGER,
+    state TEXT,                 -- NULL when the session disappeared
+    prefixes INTEGER,
+    last_change TEXT
+);
+CREATE INDEX IF NOT EXISTS peer_history_peer ON peer_history (router, ip, time);
+CREATE INDEX IF NOT EXISTS peer_history_asn ON peer_history (asn, time);
+CREATE INDEX IF NOT EXISTS peer_history_time ON peer_history (time);
+'''
+
+COLUMNS = ('time', 'router', 'ip', 'afi', 'safi', 'asn', 'state', 'prefixes', 'last_change')
+
+_units = { 'y': 365 * 86400, 'w': 7 * 86400, 'd': 86400, 'h': 3600, 'm': 60, 's': 1 }
+_parsed = {}
+
+def uptime_seconds(text):
+    '''
+    Parse the time since the last state change as printed by the routers,
+    e.g. "2w0d", "1d02h", "00:12:34", "1w2d 3:04:05" or "5:07". Returns
+    None for "never" and anything else not understood.
+    '''
+    if not text:
+        return None
+    try:
+        return _parsed[text]
+    except KeyError:
+        pass
+    if len(_parsed) > 100000:
+        _parsed.clear()
+    _parsed[text] = seconds = _uptime_seconds(text)
+    return seconds
+
+def _uptime_seconds(text):
+    seconds = 0
+    rest = text.strip()
+    for value, unit in re.findall(r'(\d+)([ywdhms])', rest):
+        seconds += int(value) * _units[unit]
+    rest = re.sub(r'\d+[ywdhms]', '', rest).strip()
+
+    if rest:
+        if not re.match(r'^\d+(:\d+){1,2}$', rest):
+            return None
+        parts = [ int(p) for p in rest.split(':') ]
+        if len(parts) == 2:
+            parts.insert(0, 0)
+        seconds += parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return seconds
+
+class History:
+    '''Append-only store of changes to BGP sessions'''
+
+    def __init__(self, path, retention=90, prune_every=3600):
+        self.path = path
+        self.retention = retention * 86400 if retention else None
+        self.prune_every = prune_every
+        self._lock = threading.Lock()
+        self._pruned = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+        self._last = self._load() # router -> { (ip, afi, safi): state }
+
+    def _load(self):
+        '''The last known state of every session still present'''
+        last = {}
+        rows = self.db.execute('''
+            SELECT h.router, h.ip, h.afi, h.safi, h.state, h.prefixes, h.last_change
+            FROM peer_history h JOIN (
+                SELECT router, ip, afi, safi, MAX(time) AS time
+                FROM peer_history GROUP BY router, ip, afi, safi
+            ) l USING (router, ip, afi, safi, time)''')
+        for router, ip, afi, safi, state, prefixes, last_change in rows:
+            if state is not None:
+                last.setdefault(router, {})[(ip, afi, safi)] = (state, prefixes, last_change)
+        log.info('history: %d sessions in %s', sum(map(len, last.values())), self.path)
+        return last
+
+    def _changed(self, old, new):
+        '''Compare (state, prefixes, last_change) of a session in two refreshes'''
+        if old is None or old[:2] != new[:2]:
+            return True
+        if old[2] == new[2]:
+            return False
+        before, after = uptime_seconds(old[2]), uptime_seconds(new[2])
+        return before is not None and after is not None and after < before
+
+    def record(self, router, peers, now=None):
+        '''Store the sessions of router which changed since the last refresh'''
+        now = int(now or time.time())
+        rows = []
+        with self._lock:
+            last = self._last.get(router, {})
+            current = {}
+            for p in peers:
+                key = (p.ip, p.afi, p.safi)
+                state = (p.state, p.prefixes, p.last_change)
+                if self._changed(last.get(key), state):
+                    rows.append((now, router, p.ip, p.afi, p.safi, p.asn) + state)
+                current[key] = state
+
+            for key in last:
+                if key not in current:
+                    rows.append((now, router) + key + (None, None, None, None))
+            self._last[router] = current
+
+            if rows:
+                with self.db:
+                    self.db.executemany('INSERT INTO peer_history VALUES (?,?,?,?,?,?,?,?,?)', rows)
+
+            if self.retention and now - self._pruned >= self.prune_every:
+                self._prune(now)
+        return len(rows)
+
+    def _prune(self, now):
+        '''Must hold the lock'''
+        self._pruned = now
+        with self.db:
+            deleted = self.db.execute('DELETE FROM peer_history WHERE time < ?',
+                    (now - self.retention,)).rowcount
+        if deleted:
+            self.db.execute('PRAGMA incremental_vacuum')
+            log.info('history: pruned %d rows', deleted)
+
+    def _query(self, where, args, since, until, limit):
+        if since:
+            where.append('time >= ?')
+            args.append(int(since))
+        if until:
+            where.append('time < ?')
+            args.append(int(until))
+        sql = 'SELECT %s FROM peer_history WHERE %s ORDER BY time DESC LIMIT ?' % (
+                ', '.join(COLUMNS), ' AND '.join(where))
+        with self._lock:
+            rows = self.db.execute(sql, args + [ limit ]).fetchall()
+        return [ dict(zip(COLUMNS, row)) for row in rows ]
+
+    def peer(self, router, ip, since=None, until=None, limit=1000):
+        '''Changes of the sessions of router with ip, newest first'''
+        return self._query([ 'router = ?', 'ip = ?' ], [ router, ip ], since, until, limit)
+
+    def asn(self, asn, since=None, until=None, limit=1000):
+        '''Changes of the sessions with asn on any router, newest first'''
+        return self._query([ 'asn = ?' ], [ int(asn) ], since, until, limit)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
@@ -0,0 +1,121 @@
+'''
+Which PeeringDB participant and exchange an address belongs to
+
+The interface address of every participant at every exchange is kept in
+a dict, and the LANs of the exchanges as sorted ranges of integers per IP
+version. Looking up a peer is a hash lookup for the participant and a
+binary search for the exchange, so a page of the peers table is
+annotated in no time.
+
+    index = IPIndex(peeringdb.load_addresses)
+    index.start(3600)
+    index.annotate(peer)
+'''
+
+import bisect, logging, netaddr, threading, time
+
+log = logging.getLogger(__name__)
+
+class Participant(object):
+    '''A participant's interface at an exchange'''
+    __slots__ = ('asn', 'name', 'exchange')
+
+    def __init__(self, asn, name, exchange):
+        self.asn = asn
+        self.name = name
+        self.exchange = exchange
+
+class _Ranges:
+    '''Non-overlapping (first, last, value) ranges of one IP version'''
+    def __init__(self, ranges):
+        self.ranges = sorted(ranges)
+        self.firsts = [ r[0] for r in self.ranges ]
+
+    def find(self, value):
+        i = bisect.bisect_right(self.firsts, value) - 1
+        if i >= 0 and self.ranges[i][1] >= value:
+            return self.ranges[i][2]
+        return None
+
+class IPIndex:
+    '''
+    Participants by address and exchanges by LAN, reloaded periodically
+
+    load() returns (interfaces, lans): iterables of (address, asn, name,
+    exchange) and (prefix, exchange).
+    '''
+    def __init__(self, load=None):
+        self.load = load
+        self.loaded = None # time of the last successful reload
+        self._addresses = {}
+        self._lans = { 4: _Ranges([]), 6: _Ranges([]) }
+        self._thread = None
+
+    def update(self, interfaces, lans):
+        '''Replace the contents of the index'''
+        addresses = {}
+        for addr, asn, name, exchange in interfaces:
+            try:
+                ip = netaddr.IPAddress(addr.strip())
+            except (netaddr.AddrFormatError, ValueError, AttributeError):
+                continue
+            addresses[ip] = Participant(asn, name, exchange)
+
+        ranges = { 4: [], 6: [] }
+        for prefix, exchange in lans:
+            try:
+                net = netaddr.IPNetwork(prefix.strip())
+            except (netaddr.AddrFormatError, ValueError, AttributeError):
+                log.debug('ignoring exchange LAN %r of %s', prefix, exchange)
+                continue
+            ranges[net.version].append((net.first, net.last, exchange))
+
+        # swapped in one go, lookups never see a half built index
+        self._addresses, self._lans = addresses, dict((v, _Ranges(r)) for v, r in ranges.items())
+        self.loaded = time.time()
+        log.info('ip index: %d addresses, %d exchange LANs', len(addresses),
+                len(ranges[4]) + len(ranges[6]))
+
+    def reload(self):
+        self.update(*self.load())
+
+    def lookup(self, ip):
+        '''(Participant or None, exchange or None) of ip'''
+        try:
+            ip = netaddr.IPAddress(ip)
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            return None, None
+        participant = self._addresses.get(ip)
+        if participant:
+            return participant, participant.exchange
+        return None, self._lans[ip.version].find(ip.value)
+
+    def annotate(self, peer):
+        '''The PeeringDB fields of a utils.Peer as a dict'''
+        participant, exchange = self.lookup(peer.ip)
+        return {
+            'pdb_name': participant and participant.name,
+            'pdb_asn': participant and participant.asn,
+            'pdb_exchange': exchange,
+            'asn_mismatch': bool(participant and peer.asn is not None
+                and participant.asn != peer.asn),
+        }
+
+    def mismatches(self, peers):
+        '''The peers whose ASN differs from the one in PeeringDB'''
+        return [ dict(p._json(), **a) for p, a in ((p, self.annotate(p)) for p in peers)
+                if a['asn_mismatch'] ]
+
+    def start(self, interval):
+        '''Load now and every interval seconds in a thread'''
+        def run():
+            while True:
+                try:
+                    self.reload()
+                except Exception:
+                    log.error('error loading the ip index', exc_info=True)
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=run, name='ip-index')
+        self._thread.daemon = True
+        self._thread.start()
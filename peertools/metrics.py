@@ -0,0 +1,124 @@
+'''
+Prometheus metrics of peerweb
+
+The text of every metric family is kept per router and only rebuilt when
+that router is refreshed, so a scrape of many thousand sessions just joins
+strings, or returns the same body as the previous scrape if nothing
+changed in between.
+'''
+
+import gzip, threading
+
+from cStringIO import StringIO
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+FAMILIES = [
+    ('peertools_refresh_duration_seconds', 'histogram', 'Time taken by refreshes of a router'),
+    ('peertools_refresh_errors_total', 'counter', 'Failed refreshes of a router by error'),
+    ('peertools_last_success_timestamp_seconds', 'gauge', 'Unix time of the last successful refresh'),
+    ('peertools_router_peers', 'gauge', 'Sessions seen on a router at the last refresh'),
+    ('peertools_session_up', 'gauge', '1 if the session is established, else 0'),
+    ('peertools_session_prefixes', 'gauge', 'Prefixes received on an established session'),
+]
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+
+def _value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics:
+    '''Metric samples kept as text per family and router'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._text = dict((name, {}) for name, _, _ in FAMILIES)
+        self._durations = {} # router -> [ bucket counts, sum, count ]
+        self._errors = {}    # router -> { error: count }
+        self._version = 0
+        self._rendered = None
+
+    def _set(self, family, router, lines):
+        '''Must hold the lock'''
+        self._text[family][router] = ''.join(lines)
+        self._version += 1
+
+    def refreshed(self, router, seconds, ok, error=None, when=None):
+        '''Account for one refresh of router which took seconds'''
+        with self._lock:
+            counts, total, count = self._durations.get(router) or ([ 0 ] * len(self.buckets), 0.0, 0)
+            counts = [ n + (seconds <= le) for n, le in zip(counts, self.buckets) ]
+            total, count = total + seconds, count + 1
+            self._durations[router] = (counts, total, count)
+
+            name = 'peertools_refresh_duration_seconds'
+            lines = [ '%s_bucket%s %d\n' % (name, _labels(router=router, le=le), n)
+                    for le, n in zip(self.buckets, counts) ]
+            lines.append('%s_bucket%s %d\n' % (name, _labels(router=router, le='+Inf'), count))
+            lines.append('%s_sum%s %s\n' % (name, _labels(router=router), _value(total)))
+            lines.append('%s_count%s %d\n' % (name, _labels(router=router), count))
+            self._set(name, router, lines)
+
+            if ok:
+                self._set('peertools_last_success_timestamp_seconds', router, [
+                    'peertools_last_success_timestamp_seconds%s %s\n' % (
+                        _labels(router=router), _value(float(when)))
+                    ])
+            else:
+                errors = self._errors.setdefault(router, {})
+                errors[error] = errors.get(error, 0) + 1
+                self._set('peertools_refresh_errors_total', router, [
+                    'peertools_refresh_errors_total%s %d\n' % (_labels(router=router, error=e), n)
+                    for e, n in sorted(errors.items())
+                    ])
+
+    def sessions(self, router, peers):
+        '''Replace the session gauges of router'''
+        up, prefixes = [], []
+        for p in peers:
+            labels = _labels(router=router, ip=p.ip, afi=p.afi, safi=p.safi, asn=p.asn)
+            established = p.state == 'Established'
+            up.append('peertools_session_up%s %d\n' % (labels, established))
+            if established and p.prefixes is not None:
+                prefixes.append('peertools_session_prefixes%s %d\n' % (labels, p.prefixes))
+
+        with self._lock:
+            self._set('peertools_router_peers', router, [
+                'peertools_router_peers%s %d\n' % (_labels(router=router), len(peers))
+                ])
+            self._set('peertools_session_up', router, up)
+            self._set('peertools_session_prefixes', router, prefixes)
+
+    def render(self, compress=False):
+        '''Return the exposition text, gzipped if compress is set'''
+        with self._lock:
+            version = self._version
+            rendered = self._rendered
+        if not rendered or rendered[0] != version:
+            rendered = (version, self._join(), None)
+        if compress and rendered[2] is None:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1, mtime=0) as f:
+                f.write(rendered[1])
+            rendered = rendered[:2] + (buf.getvalue(),)
+
+        with self._lock:
+            if self._version == rendered[0]:
+                self._rendered = rendered
+        return rendered[2] if compress else rendered[1]
+
+    def _join(self):
+        with self._lock:
+            parts = []
+            for name, type, help in FAMILIES:
+                parts.append('# HELP %s %s\n# TYPE %s %s\n' % (name, help, name, type))
+                text = self._text[name]
+                parts.extend(text[router] for router in sorted(text))
+        return ''.join(parts)
@@ -0,0 +1,224 @@
+'''
+Parsers for vendor output
+
+Each parser takes an iterable of output lines and yields utils.Peer
+objects. Parsers for structured output (JSON, XML) raise ValueError when
+the router did not understand the command, so callers can fall back to
+the next one. The text parsers yield peers as soon as their row arrived.
+
+Peers are tagged with the address family (afi, safi) they were listed in,
+a session carrying several families is listed once for each.
+'''
+
+import json, re
+import utils
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+IPV4 = ('ipv4', 'unicast')
+IPV6 = ('ipv6', 'unicast')
+
+def _peer(ip, asn, last_change, state, prefixes=None, af=None):
+    peer = utils.Peer()
+    peer.ip = ip
+    peer.afi, peer.safi = af or (IPV6 if ':' in ip else IPV4)
+    if peer.afi in ('ipv4', 'ipv6'):
+        peer.ver = 6 if peer.afi == 'ipv6' else 4
+    else:
+        peer.ver = 6 if ':' in ip else 4
+    peer.asn = parse_asn(asn)
+    peer.last_change = last_change
+    peer.state = state
+    peer.prefixes = int(prefixes) if prefixes is not None else None
+    return peer
+
+def parse_asn(asn):
+    '''Accept plain and asdot notation'''
+    asn = str(asn)
+    if '.' in asn:
+        high, low = asn.split('.')
+        return int(high) * 65536 + int(low)
+    return int(asn)
+
+#### Text ####
+
+_cisco_row = re.compile(r'''
+    ^(?P<ip>[\da-fA-F.:]+)?\s+  # Neighbor, missing when wrapped
+    (?P<ver>[46])\s+            # BGP version
+    (?P<asn>[\d.]+)\s+          # AS Number
+    (?:\d+\s+){5}               # MsgRcvd, MsgSent, TblVer, InQ, OutQ
+    (?P<updown>\S+)\s+          # last state change
+    (?P<state>\S.*?)\s*$        # State/PfxRcd
+''', re.VERBOSE)
+
+_cisco_ip = re.compile(r'^(?P<ip>[\da-fA-F.:]+)\s*$')
+_cisco_af = re.compile(r'^For address family: (\S+) (\S+)')
+_cisco_error = re.compile(r'^% (Invalid input|Unknown command|Ambiguous command)')
+
+def cisco_summary(lines, afs=None):
+    '''
+    Parse "show bgp all summary" from IOS and the summaries from Quagga.
+    Long IPv6 addresses get a line of their own. Example:
+
+    For address family: IPv6 Unicast
+    BGP router identifier 193.0.0.56, local AS number 3333
+    Neighbor        V           AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd
+    12.0.1.63       4         7018 4336594   15901        0    0    0 02w0d16h   469820
+    2001:DB8:1000::1
+                    4        65001       0       0        1    0    0 never    Idle (Admin)
+
+    Without "For address family" headers, the n-th summary in the output
+    belongs to afs[n] if given.
+    '''
+    af = None
+    tables = 0
+    wrapped = None
+    found = False
+    for line in lines:
+        m = _cisco_row.match(line)
+        if m:
+            ip = m.group('ip') or wrapped
+            wrapped = None
+            if not ip:
+                continue
+            found = True
+            state = m.group('state')
+            if state.isdigit():
+                yield _peer(ip, m.group('asn'), m.group('updown'), 'Established', state, af)
+            else:
+                yield _peer(ip, m.group('asn'), m.group('updown'), state, None, af)
+            continue
+
+        m = _cisco_ip.match(line)
+        wrapped = m.group('ip') if m and ('.' in line or ':' in line) else None
+
+        m = _cisco_af.match(line)
+        if m:
+            af = (m.group(1).lower(), m.group(2).lower())
+        elif line.startswith('BGP router identifier'):
+            if afs and tables < len(afs):
+                af = afs[tables]
+            tables += 1
+        elif _cisco_error.match(line) and not found:
+            raise ValueError(line)
+
+def parse_cisco_peer_summary_line(line):
+    '''Parse a single row of a Cisco style summary, or return None'''
+    for peer in cisco_summary([ line ]):
+        return peer
+
+#### Structured ####
+
+def _document(lines, start, end):
+    '''Cut a document out of the output, which includes the echoed command'''
+    text = '\n'.join(lines)
+    first, last = text.find(start), text.rfind(end)
+    if first < 0 or last < first:
+        raise ValueError('no structured output: %r' % text[:200])
+    return text[first:last + len(end)]
+
+def _json_documents(lines):
+    '''Decode one or more JSON documents printed one after the other'''
+    text = _document(lines, '{', '}')
+    decoder = json.JSONDecoder()
+    docs = []
+    pos = 0
+    while pos < len(text):
+        doc, pos = decoder.raw_decode(text, pos)
+        docs.append(doc)
+        next = text.find('{', pos)
+        if next < 0:
+            break
+        pos = next
+    return docs
+
+_frr_af = re.compile('^(ipv4|ipv6|l2vpn)(.+)$', re.IGNORECASE)
+
+_junos_ribs = {
+    'inet.0': IPV4,
+    'inet.2': ('ipv4', 'multicast'),
+    'inet6.0': IPV6,
+    'inet6.2': ('ipv6', 'multicast'),
+    'inetflow.0': ('ipv4', 'flowspec'),
+    'bgp.l3vpn.0': ('ipv4', 'vpn'),
+    'bgp.l3vpn-inet6.0': ('ipv6', 'vpn'),
+    'bgp.evpn.0': ('l2vpn', 'evpn'),
+}
+
+_nxos_afis = { 1: 'ipv4', 2: 'ipv6', 25: 'l2vpn' }
+_nxos_safis = { 1: 'unicast', 2: 'multicast', 128: 'vpn', 70: 'evpn' }
+
+def _rows(table, row):
+    '''NX-OS uses a dict for one row and a list for more'''
+    if not table:
+        return []
+    rows = table.get(row, [])
+    return rows if isinstance(rows, list) else [ rows ]
+
+def junos_summary_xml(lines):
+    '''Parse "show bgp summary | display xml" from JunOS'''
+    xml = _document(lines, '<rpc-reply', '</rpc-reply>')
+    xml = re.sub('xmlns="[^"]+"', '', xml)
+    try:
+        root = ET.fromstring(xml)
+    except SyntaxError, e: # ParseError
+        raise ValueError(str(e))
+
+    for node in root.findall('*/bgp-peer'):
+        args = (node.findtext('peer-address'), node.findtext('peer-as'),
+                node.findtext('elapsed-time'), node.findtext('peer-state'))
+
+        ribs = node.findall('bgp-rib')
+        if not ribs:
+            yield _peer(*args)
+
+        for rib in ribs:
+            name = rib.findtext('name')
+            af = _junos_ribs.get(name)
+            if not af:
+                af = (IPV6 if 'inet6' in name else IPV4)[0], name
+            yield _peer(*args, prefixes=rib.findtext('received-prefix-count'), af=af)
+
+def frr_summary_json(lines, afs=None):
+    '''
+    Parse "show bgp summary json" from FRR and recent Quagga. The peers are
+    either grouped by address family, e.g.
+
+    {"ipv4Unicast": {"peers": {"192.0.2.1": {"remoteAs": 64496, ...}}}}
+
+    or at the top level of one document per command, which then belongs
+    to afs[n] if given.
+    '''
+    for n, doc in enumerate(_json_documents(lines)):
+        if 'peers' in doc:
+            af = afs[n] if afs and n < len(afs) else None
+            tables = [ (af, doc) ]
+        else:
+            tables = []
+            for key, table in sorted(doc.items()):
+                m = _frr_af.match(key)
+                if m and isinstance(table, dict) and 'peers' in table:
+                    tables.append(((m.group(1).lower(), m.group(2).lower()), table))
+
+        for af, table in tables:
+            for ip, p in sorted(table['peers'].items()):
+                prefixes = p.get('prefixReceivedCount', p.get('pfxRcd'))
+                yield _peer(ip, p['remoteAs'], p.get('peerUptime'), p.get('state'), prefixes, af)
+
+def nxos_summary_json(lines):
+    '''Parse "show bgp all summary | json" from NX-OS'''
+    for doc in _json_documents(lines):
+        for vrf in _rows(doc.get('TABLE_vrf'), 'ROW_vrf'):
+            for af in _rows(vrf.get('TABLE_af'), 'ROW_af'):
+                afi = _nxos_afis.get(int(af.get('af-id', 1)), af.get('af-id'))
+                for saf in _rows(af.get('TABLE_saf'), 'ROW_saf'):
+                    safi = _nxos_safis.get(int(saf.get('safi', 1)), saf.get('safi'))
+                    for n in _rows(saf.get('TABLE_neighbor'), 'ROW_neighbor'):
+                        prefixes = n.get('prefixreceived')
+                        if n.get('state') != 'Established':
+                            prefixes = None
+                        yield _peer(n['neighborid'], n['neighboras'], n.get('time'),
+                                n.get('state'), prefixes, (afi, safi))
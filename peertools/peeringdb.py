@@ -1,30 +1,43 @@
 '''
 PeeringDB API
+
+The tables can be queried in the PeeringDB database itself, or in a local
+SQLite snapshot of it which sync() keeps up to date. The snapshot is
+indexed for the lookups below and has full text indexes for searching by
+name, so it answers instantly and works offline.
 '''
 
-import argparse, logging
+import argparse, logging, os, re, time
 
 from prettytable import PrettyTable
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, aliased, backref
-from sqlalchemy.sql import func, select, text
+from sqlalchemy.orm import sessionmaker, relationship, aliased, backref, contains_eager, joinedload, noload
+from sqlalchemy.sql import func, select, text, table, column
 from sqlalchemy import Column, Integer, ForeignKey, String, create_engine, or_
 
 #### Globals ####
 
 log = logging.getLogger(__name__)
 db = None
+snapshot = None # path of the SQLite snapshot in use
 
-def init(dburl, verbose):
-    global db
+def init(dburl, verbose, snapshot_path=None):
+    '''Connect to dburl, or to the snapshot at snapshot_path which is made from dburl if missing'''
+    global db, snapshot
     
     logging.getLogger('sqlalchemy.engine').level = logging.INFO if verbose else logging.WARN
 
+    if snapshot_path:
+        if not os.path.exists(snapshot_path):
+            sync(dburl, snapshot_path)
+        dburl = 'sqlite:///' + snapshot_path
+        snapshot = snapshot_path
+
     engine = create_engine(dburl)
     SqlSession = sessionmaker(bind=engine)
     db = SqlSession()
-    db.execute("select true");
+    db.execute("select 1");
     log.info('ready dburl=%s', dburl)
 
 #### Schema ####
@@ -99,6 +112,154 @@ class Router(Base):
     exchange = relationship(Exchange, backref=backref('routers', lazy=True), lazy='joined')
     peer = relationship(Peer, backref=backref('routers', lazy=True), lazy='joined')
 
+#### Local snapshot ####
+
+SNAPSHOT_SCHEMA = [
+    'CREATE INDEX IF NOT EXISTS peer_asn ON peerParticipants (asn)',
+    'CREATE INDEX IF NOT EXISTS router_peer ON peerParticipantsPublics (participant_id)',
+    'CREATE INDEX IF NOT EXISTS router_exchange ON peerParticipantsPublics (public_id, participant_id)',
+    'CREATE INDEX IF NOT EXISTS router_addr ON peerParticipantsPublics (local_ipaddr)',
+    'CREATE INDEX IF NOT EXISTS contact_peer ON peerParticipantsContacts (participant_id)',
+    'CREATE INDEX IF NOT EXISTS network_exchange ON mgmtPublicsIPs (public)',
+    'CREATE TABLE IF NOT EXISTS snapshot_sync (tablename TEXT PRIMARY KEY, rows INTEGER, synced INTEGER)',
+]
+
+# full text index per table: name of the index, columns to index
+SNAPSHOT_FTS = {
+    'peerParticipants': ('peer_fts', ('name', 'asn')),
+    'peerParticipantsContacts': ('contact_fts', ('name',)),
+    'mgmtPublics': ('exchange_fts', ('name', 'name_long', 'website')),
+}
+
+def _chunks(items, size=500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def sync(dburl, path):
+    '''
+    Copy the tables at dburl into the SQLite snapshot at path. Only rows
+    which were added, changed or removed since the last sync are written.
+    Returns { table name: number of rows written }
+    '''
+    remote = create_engine(dburl)
+    local = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(local)
+
+    written = {}
+    with local.begin() as con:
+        for statement in SNAPSHOT_SCHEMA:
+            con.execute(statement)
+        for fts, columns in SNAPSHOT_FTS.values():
+            con.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts4(%s)' % (fts, ', '.join(columns)))
+
+        for t in Base.metadata.sorted_tables:
+            keys = [ c.key for c in t.c ]
+            rows = dict((row[t.c.id], tuple(row)) for row in remote.execute(select(list(t.c))))
+            have = dict((row[t.c.id], tuple(row)) for row in con.execute(select(list(t.c))))
+            changed = [ r for id, r in rows.items() if have.get(id) != r ]
+            stale = [ id for id, r in have.items() if rows.get(id) != r ]
+
+            for ids in _chunks(stale):
+                con.execute(t.delete().where(t.c.id.in_(ids)))
+            if changed:
+                con.execute(t.insert(), [ dict(zip(keys, r)) for r in changed ])
+
+            if t.name in SNAPSHOT_FTS:
+                fts, columns = SNAPSHOT_FTS[t.name]
+                for ids in _chunks(stale):
+                    con.execute('DELETE FROM %s WHERE docid IN (%s)' % (fts, ','.join(str(int(i)) for i in ids)))
+                if changed:
+                    con.execute('INSERT INTO %s (docid, %s) VALUES (?%s)' % (fts, ', '.join(columns), ', ?' * len(columns)),
+                            [ (r[keys.index('id')],) + tuple(r[keys.index(c)] for c in columns) for r in changed ])
+
+            con.execute('INSERT OR REPLACE INTO snapshot_sync VALUES (?, ?, ?)',
+                    (t.name, len(rows), int(time.time())))
+            written[t.name] = len(set(stale) | set(r[keys.index('id')] for r in changed))
+            log.info('sync %s: %d rows, %d written', t.name, len(rows), written[t.name])
+    return written
+
+def _search(model, words, *columns):
+    '''
+    Condition matching rows of model whose columns contain words: with the
+    full text index of the snapshot each word has to start a word of the
+    indexed columns, otherwise any substring matches.
+    '''
+    terms = [ w.lower() + '*' for w in re.findall(r'\w+', str(words)) ]
+    if snapshot and terms:
+        fts = SNAPSHOT_FTS[model.__tablename__][0]
+        return model.id.in_(select([ column('docid') ]).select_from(table(fts)).where(
+            column(fts).match(' '.join(terms))))
+    return or_(*[ c.like('%{}%'.format(words)) for c in columns ])
+
+#### Queries ####
+# each loads everything its command prints in a fixed number of statements,
+# looking up peers by their indexed ASN
+
+def find_peers(words):
+    return db.query(Peer).filter(_search(Peer, words, Peer.asn, Peer.name)).all()
+
+def find_peer(asn):
+    '''The peer with asn and its routers and their exchanges'''
+    return db.query(Peer).filter_by(asn=asn).options(
+            joinedload(Peer.routers).joinedload(Router.exchange),
+            noload(Peer.routers, Router.peer),
+            ).one()
+
+def common_routers(left, right):
+    '''Pairs of routers of the ASNs left and right at the same exchange'''
+    l, r = aliased(Router), aliased(Router)
+    lp, rp = aliased(Peer), aliased(Peer)
+    return db.query(l, r).join(lp, l.peer).join(r, r.public_id == l.public_id).join(rp, r.peer).filter(
+            lp.asn == left, rp.asn == right).options(
+            contains_eager(l.peer, alias=lp), contains_eager(r.peer, alias=rp),
+            noload(r.exchange),
+            ).all()
+
+def exchange_counts(asn):
+    '''Rows of (exchange name, IPv4 routers, IPv6 routers) at the exchanges of asn'''
+    q = text('''
+        SELECT
+            mgmtPublics.name AS "Name",
+            SUM(peerParticipantsPublics.local_ipaddr NOT LIKE '%:%') AS "IPv4",
+            SUM(peerParticipantsPublics.local_ipaddr LIKE '%:%') AS "IPv6"
+        FROM 
+            mgmtPublics
+        JOIN
+            peerParticipantsPublics ON mgmtPublics.id = public_id
+        WHERE
+            peerParticipantsPublics.local_ipaddr IS NOT NULL
+            AND public_id IN (
+                SELECT public_id FROM peerParticipantsPublics
+                JOIN peerParticipants ON peerParticipants.id = participant_id
+                WHERE asn = :asn
+            )
+        GROUP BY
+            mgmtPublics.id
+    ''')
+    return db.execute(q, { 'asn': asn }).fetchall()
+
+def find_contacts(name):
+    '''Contacts of peers, and exchanges, matching name'''
+    where = or_(
+        _search(Peer, name, Peer.asn, Peer.name),
+        _search(Contact, name, Contact.name),
+        )
+    contacts = db.query(Contact).join(Contact.peer).options(contains_eager(Contact.peer)).filter(where).all()
+    exchanges = db.query(Exchange).filter(
+            _search(Exchange, name, Exchange.name, Exchange.name_long, Exchange.website)).all()
+    return contacts, exchanges
+
+def load_addresses():
+    '''
+    (interfaces, lans) for an ipindex.IPIndex: the address, ASN, name and
+    exchange of every participant's interface, and the LANs of every exchange
+    '''
+    db.rollback() # see what changed since the last load
+    interfaces = db.query(Router.addr, Peer.asn, Peer.name, Exchange.name).join(
+            Peer, Router.peer).join(Exchange, Router.exchange).filter(Router.addr != None).all()
+    lans = db.query(Network.address, Exchange.name).join(Exchange, Network.exchange).all()
+    return interfaces, lans
+
 #### Functions ####
 
 def search(text):
@@ -106,9 +267,7 @@ def search(text):
 
     x = PrettyTable('ASN Name'.split())
     
-    for row in db.query(Peer).filter(or_(
-        Peer.asn.like('%{}%'.format(text)),
-        Peer.name.like('%{}%'.format(text)))):
+    for row in find_peers(text):
         x.add_row([row.asn, row.name])
    
     print x.get_string(align="l")
@@ -117,7 +276,7 @@ def info(peer):
     '''Show meta-info and routers for a peer'''
     x = PrettyTable('Exchange Address'.split())
 
-    row = db.query(Peer).filter_by(asn=peer).one()
+    row = find_peer(peer)
     print 'Name:', row.name
     print 'ASN:', row.asn
 
@@ -128,17 +287,11 @@ def info(peer):
 
 def common(left, right):
     '''find common peering points''' 
-    l = aliased(Router)
-    r = aliased(Router)
-    
     x = PrettyTable(["Exchange", left, right])
 
-    for row in db.query(l, r).filter(
-            l.public_id == r.public_id,
-            l.peer.has(asn=left),
-            r.peer.has(asn=right)):
-        if row[0].ipver == row[1].ipver:
-            x.add_row([row[0].exchange.name, row[0].addr, row[1].addr])
+    for l, r in common_routers(left, right):
+        if l.ipver == r.ipver:
+            x.add_row([l.exchange.name, l.addr, r.addr])
 
     print x.get_string(align="l")
 
@@ -147,26 +300,7 @@ def all_possible(asn):
     x = PrettyTable('exchange ipv4 ipv6'.split())
     x.align = 'l'
   
-    q = text('''
-        SELECT
-            mgmtPublics.name AS "Name",
-            SUM(peerParticipantsPublics.local_ipaddr NOT LIKE "%:%") AS "IPv4",
-            SUM(peerParticipantsPublics.local_ipaddr LIKE "%:%") AS "IPv6"
-        FROM 
-            mgmtPublics
-        JOIN
-            peerParticipantsPublics ON mgmtPublics.id = public_id
-        WHERE
-            peerParticipantsPublics.local_ipaddr IS NOT NULL
-            AND EXISTS (
-                SELECT * from peerParticipantsPublics, peerParticipants
-                WHERE mgmtPublics.id = public_id AND peerParticipants.id = participant_id AND asn = :asn
-            )
-        GROUP BY
-            mgmtPublics.id
-    ''')
-
-    for row in db.execute(q, { 'asn': asn }):
+    for row in exchange_counts(asn):
         x.add_row(row)
 
     print x
@@ -176,24 +310,12 @@ def contacts(name):
     x = PrettyTable('thing role email'.split())
     x.align = 'l'
    
-    where = or_(
-        Peer.asn.like('%{}%'.format(name)),
-        Peer.name.like('%{}%'.format(name)),
-        Contact.name.like('%{}%'.format(name))
-        )
-
-    for row in db.query(Contact).join(Peer).filter(where):
+    contacts, exchanges = find_contacts(name)
+    for row in contacts:
         x.add_row([row.peer.name, row.role, "%s <%s>" % (row.name, row.email)])
     
-    where = or_(
-        Exchange.name.like('%{}%'.format(name)),
-        Exchange.name_long.like('%{}%'.format(name)),
-        Exchange.website.like('%{}%'.format(name)),
-        )
-    
-    for row in db.query(Exchange).filter(where):
+    for row in exchanges:
         x.add_row([row.name, 'tech', row.tech_email])
         x.add_row([row.name, 'policy', row.policy_email])
     
     print x
-
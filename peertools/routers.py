@@ -7,40 +7,90 @@ see http://pexpect.sourceforge.net/pexpect.html
 Always try to leave the console at the prompt
 '''
 
-import re, netaddr, pexpect, logging
-import xml.etree.ElementTree as ET
-import config, utils
+import re, netaddr, pexpect, logging, threading, time
+import config, parsers, sshmux, trace, utils
+
+from confcache import ConfigCache
+from functools import partial
+
+from parsers import parse_cisco_peer_summary_line
 
 log = logging.getLogger(__name__)
 
 class RouterHandle(object):
-    '''A context manager maintaining an open connection to a router'''
+    '''
+    A context manager maintaining a pool of open connections to a router
+
+    Each "with handle as con" checks out a session for exclusive use by the
+    calling thread and returns it to the pool afterwards, so several threads
+    can talk to the same router in parallel.
+    '''
 
-    def __init__(self, host, asn, password=None):
+    _login_patterns = [
+        '[Pp]assword:',
+        '\..+@.+\#',
+        'Welcome to a RIS Cluster Machine',
+        '^--- JUNOS',
+        'Permission denied',
+        pexpect.EOF,
+    ]
+
+    def __init__(self, host, asn, password=None, sessions=None, idle_timeout=None, command=None,
+            multiplex=None):
         self.host = host
         self.password = password
         self.asn = asn
+        if multiplex is None:
+            multiplex = getattr(config, 'SSH_MULTIPLEX', False)
+        self.master = None # shared by the sessions, outlives close()
+        if multiplex and not command:
+            self.master = sshmux.ControlMaster(host, getattr(config, 'SSH_CONTROL_PERSIST', 600))
+        self.command = command or [ 'ssh' ] + (self.master.options() if self.master else []) + [
+                '-oProtocol=2,1', host ]
         self.error = None
-        self._socket = None
-        self._pipe = utils.PipeLogger(logging.getLogger(self.host))
+        self.sessions = sessions or getattr(config, 'SESSIONS_PER_HOST', 2)
+        self.idle_timeout = idle_timeout or getattr(config, 'SESSION_IDLE_TIMEOUT', 300)
+        self.check_after = getattr(config, 'SESSION_CHECK_AFTER', 5)
+        self.config_cache = ConfigCache(host, getattr(config, 'CONFIG_CACHE_DIR', None),
+                getattr(config, 'CONFIG_CACHE_TTL', 300))
+        self._idle = []   # (router, last used), most recently used last
+        self._open = 0    # sessions idle, checked out or being opened
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._reconnecting = False
 
     def _connect(self):
         '''Try to connect to host (an IP or hostname) and return the correct Router object'''
         log.debug('connecting to %s', self.host)
-        args = [ '-oProtocol=2,1', self.host ]
-        
-        con = pexpect.spawn('ssh', args)
-        con.logfile_read = self._pipe
+        multiplexed = False
+        if self.master:
+            with trace.span('master'):
+                multiplexed = self.master.ensure(self.password)
+        with trace.span('spawn'):
+            con = pexpect.spawn(self.command[0], self.command[1:])
+        pipe = utils.PipeLogger(logging.getLogger(self.host))
+        con.logfile_read = pipe
         con.timeout = 10
 
-        i = con.expect([
-            '[Pp]assword:',
-            '\..+@.+\#',
-            'Welcome to a RIS Cluster Machine',
-            '^--- JUNOS',
-            'Permission denied',
-            pexpect.EOF,
-            ])
+        try:
+            with trace.span('login'):
+                router = self._login(con, multiplexed)
+        except:
+            pipe.clear()
+            con.close(force=True)
+            raise
+
+        router.pipe = pipe
+        return router
+
+    def _login(self, con, multiplexed=False):
+        '''Detect the vendor on a fresh connection and prepare it for use'''
+        patterns = self._login_patterns
+        if multiplexed:
+            # a channel on the master asks no password, so a Cisco shows
+            # nothing but its prompt
+            patterns = patterns + Cisco._prompts
+        i = con.expect(patterns)
         if i == 0:
             if self.password:
                 con.sendline(self.password)
@@ -58,6 +108,8 @@ class RouterHandle(object):
         elif i == 3:
             # no password required
             router = Juniper()
+        elif i >= len(self._login_patterns):
+            router = Cisco()
         else:
             data = con.match.group() if con.match != pexpect.EOF else "NO MATCH"
             raise RuntimeError('login failed: %s: %s' % (self.host, con.before + data))
@@ -67,7 +119,9 @@ class RouterHandle(object):
 
         router.con = con
         router.our_asn = self.asn
-        router.connect()
+        router.handle = self
+        with trace.span('setup'):
+            router.connect()
     
         # FIXME: remove hack when all RIS machines are equal
         if i == 2:
@@ -75,66 +129,371 @@ class RouterHandle(object):
 
         return router
 
-    def __enter__(self):
-        '''Re-establish the connection if needed. Returns the connection object'''
-        if self._socket:
-            try:
-                self._socket.cmd('')
-                log.debug('reusing socket to %s', self.host)
-                return self._socket
-            except:
-                self._socket = None
-
-        log.info('opening socket to %s', self.host)
+    def checkout(self, wait=True, idle_only=False):
+        '''
+        Take a live session from the pool, opening a new one if needed and
+        not idle_only. If all sessions are in use, wait for one or return None.
+        '''
+        while True:
+            router = None
+            with self._cond:
+                while not router:
+                    if self._idle:
+                        router, used = self._idle.pop()
+                        idle = time.time() - used
+                        if idle > self.idle_timeout:
+                            log.debug('closing idle session to %s', self.host)
+                            self._discard(router)
+                            router = None
+                    elif self._open < self.sessions and not idle_only:
+                        self._open += 1
+                        break
+                    elif not wait or idle_only:
+                        return None
+                    else:
+                        self._cond.wait()
+
+            if not router:
+                return self._open_session()
+
+            if idle < self.check_after or self._alive(router):
+                log.debug('reusing session to %s', self.host)
+                return router
+
+            with self._cond:
+                self._discard(router)
+                self._cond.notify()
+
+    def idle(self):
+        '''The number of sessions waiting in the pool'''
+        with self._cond:
+            return len(self._idle)
+
+    def _open_session(self):
+        '''Connect a session which was already counted as open'''
+        log.info('opening session to %s', self.host)
         try:
-            self._socket = self._connect()
-            return self._socket
+            return self._connect()
         except Exception, e:
             self.error = e.__class__.__name__
-            self._pipe.clear()
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
             raise
 
+    def checkin(self, router, broken=False):
+        '''Return a session to the pool. Broken sessions are replaced in the background'''
+        if broken:
+            router.pipe.clear()
+            with self._cond:
+                self._discard(router)
+                self._cond.notify()
+            self._reconnect()
+        else:
+            with self._cond:
+                self._idle.append((router, time.time()))
+                self._cond.notify()
+
+    def _alive(self, router):
+        try:
+            router.cmd('')
+            return True
+        except Exception:
+            log.info('session to %s is dead', self.host)
+            return False
+
+    def _discard(self, router):
+        '''Must hold the lock'''
+        self._open -= 1
+        try:
+            router.con.close(force=True)
+        except Exception:
+            pass
+
+    def _reconnect(self):
+        '''Open a replacement session without making anybody wait for it'''
+        with self._cond:
+            if self._reconnecting or self._idle or self._open >= self.sessions:
+                return
+            self._reconnecting = True
+            self._open += 1
+
+        def run():
+            try:
+                router = self._open_session()
+            except Exception, e:
+                log.warn('background reconnect to %s failed: %s', self.host, e)
+                return
+            finally:
+                with self._cond:
+                    self._reconnecting = False
+            self.checkin(router)
+
+        t = threading.Thread(target=run, name='reconnect-%s' % self.host)
+        t.daemon = True
+        t.start()
+
+    def __enter__(self):
+        '''Check out a session for this thread. Returns the connection object'''
+        with trace.span('checkout'):
+            router = self.checkout()
+        trace.set_vendor(router.__class__.__name__)
+        self._stack().append(router)
+        return router
+
     def __exit__(self, type, value, traceback):
+        router = self._stack().pop()
         if value:
+            # the session may be stuck in the middle of a command
             self.error = str(value)
-            self._pipe.clear()
+        self.checkin(router, broken=value is not None)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
 
     def close(self):
-        if self._socket:
-            self._socket.close()
-        self._socket = None
+        '''Log out of all idle sessions'''
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+
+        for router, used in idle:
+            try:
+                router.close()
+            except Exception:
+                router.con.close(force=True)
 
 class Router:
+    '''
+    Base class for the vendor dialects
+
+    Vendors describe their commands in _peers_cmds, _hardware_cmd,
+    _connect_cmds and _peer_info_cmds() and parse the output with the
+    functions in parsers.py and _parse_hardware(), so the same dialect can
+    be driven by pexpect here or by the poller in aio.py.
+
+    The configuration is fetched with _config_cmd into a ConfigSnapshot,
+    checked against the output of _config_revision_cmd before use.
+    '''
+    _connect_prompt = False # wait for a prompt after login
+    _connect_cmds = []
+    _hardware_cmd = None
+    _config_cmd = None
+    _config_revision_cmd = None # None: fetched again after CONFIG_CACHE_TTL
+    _config_group_re = None # the name of the group a line defines
+    _config_context_re = None # lines shown with those of every neighbor
+    _config_cache = None
+    _peers_mode = 0 # index of the _peers_cmds entry in use
+    handle = None # the RouterHandle whose pool the session belongs to
+    _prompt_window = 256 # longest prompt looked for
+
+    def connect(self):
+        if self._connect_prompt:
+            self.prompt()
+        for cmd in self._connect_cmds:
+            self.cmd(cmd)
+
+    def peers(self):
+        with trace.span('peers'):
+            return list(self.iter_peers())
+
+    def hardware(self):
+        with trace.span('hardware'):
+            output = self.cmd(self._hardware_cmd) if self._hardware_cmd else ''
+            return self._parse_hardware(output)
+
+    def peer_info(self, ip):
+        '''
+        Run the _peer_info_cmds and return their output by key
+
+        Idle sessions of the pool take commands as well, the last and
+        slowest first, so this takes about as long as the slowest one. No
+        session is opened for it, logging in takes longer than the commands.
+        A command failing on another session is run again on this one.
+        '''
+        cmds = self._peer_info_cmds(ip)
+        pending = list(cmds)
+        info = {}
+        cond = threading.Condition()
+
+        def run(router):
+            while True:
+                with cond:
+                    if not pending:
+                        return
+                    key, cmd = item = pending.pop()
+                try:
+                    output = cmd(router) if callable(cmd) else router.cmd(cmd)
+                except Exception:
+                    with cond:
+                        pending.append(item)
+                        cond.notify()
+                    raise
+                with cond:
+                    info[key] = output
+                    cond.notify()
+
+        if self.handle:
+            for i in range(min(len(cmds) - 1, self.handle.idle())):
+                t = threading.Thread(target=_help, args=(self.handle, run),
+                        name='peer-info-%s' % self.handle.host)
+                t.daemon = True
+                t.start()
+
+        while True:
+            run(self)
+            with cond:
+                while not pending and len(info) < len(cmds):
+                    cond.wait()
+                if len(info) == len(cmds):
+                    return info
+
+    def config(self):
+        '''The ConfigSnapshot of the router, shared by the sessions of the pool'''
+        if self.handle:
+            return self.handle.config_cache.get(self)
+        if not self._config_cache:
+            self._config_cache = ConfigCache(self.__class__.__name__)
+        return self._config_cache.get(self)
+
+    def neighbor_config(self, ip):
+        return _join(self.config().neighbor(ip))
+
+    def groups(self):
+        return '\n'.join(self.config().groups())
+
+    def apply_config(self, conf):
+        '''Commit conf, the cached configuration is outdated then'''
+        try:
+            self._apply_config(conf)
+        finally:
+            if self.handle:
+                self.handle.config_cache.invalidate()
+            self._config_cache = None
+
     def cmd(self, cmd):
-        '''run commands line-by-line and return the result'''
-        result = ''
+        '''run commands and return the result'''
+        return ''.join(self.stream(cmd))
 
-        cmd = cmd.strip().splitlines()
-        if not cmd:
-            cmd = [ '' ]
+    def stream(self, cmd):
+        '''
+        Run commands and yield the output in chunks of whole lines as it arrives
+
+        All lines are typed in one batch, the output of each one ends at the
+        prompt following it. Always consume the whole iterator.
+        '''
+        lines = [ line.strip() for line in cmd.strip().splitlines() ] or [ '' ]
+
+        # discard remaining data to avoid desyncronization
+        self.con.buffer = ''
+        try:
+            self.con.read_nonblocking(size=99999, timeout=0)
+        except pexpect.TIMEOUT:
+            pass # good
+
+        log.debug('typing %r', lines)
+        # a config being applied is many lines, the trace gets the first and
+        # the count only, and the size of the output but never its text
+        span = trace.span('cmd', cmd=lines[0][:80], lines=len(lines), bytes=0)
+        try:
+            self.con.send(''.join(line + '\n' for line in lines))
+            for line in lines:
+                for chunk in self._until_prompt(span):
+                    yield chunk
+        finally:
+            span.finish()
+
+    def lines(self, cmd):
+        '''run commands and yield the output line by line'''
+        for chunk in self.stream(cmd):
+            for line in chunk.splitlines():
+                yield line
+
+    def _until_prompt(self, span=trace._null):
+        '''
+        yield what comes before the next prompt, whole lines at a time
+
+        Prompts are looked for in a window of the last _prompt_window bytes
+        and what arrived since, the older part of a long line waits in a list.
+        '''
+        deadline = time.time() + self.con.timeout
+        prompts = [ re.compile(pattern, re.DOTALL) for pattern in self._prompts ]
+        before = [] # not yet yielded, older than window
+        window, self.con.buffer = self.con.buffer, ''
+        start = 0 # 1 if window lacks the start of the line, '^' must not match
+
+        while True:
+            match = None
+            for pattern in prompts:
+                m = pattern.search(window, start)
+                if m and (not match or m.start() < match.start()):
+                    match = m
+
+            if match:
+                before.append(window[:match.start()])
+                yield ''.join(before)
+                self.con.buffer = window[match.end():]
+                return
+
+            # keep the newline, prompts start with one
+            cut = window.rfind('\n')
+            if cut > 0:
+                before.append(window[:cut])
+                yield ''.join(before)
+                before = []
+                window, start = window[cut:], 0
+            elif len(window) > self._prompt_window + 1:
+                # one byte more than searched, so '^' sees it is not the start
+                before.append(window[:-self._prompt_window - 1])
+                window, start = window[-self._prompt_window - 1:], 1
 
-        for line in cmd:
             try:
-                # discard remaining data to avoid desyncronization
-                self.con.read_nonblocking(size=99999, timeout=0.01)
-            except pexpect.TIMEOUT:
-                pass # good
-            log.debug('typing %r', line.strip())
-            self.con.sendline(line.strip())
-            result += self.prompt()
-
-        return result
-    
+                waited = time.time()
+                data = self.con.read_nonblocking(size=65536,
+                        timeout=max(0, deadline - time.time()))
+                span.add('wait', time.time() - waited)
+                span.add('bytes', len(data))
+                window += data
+            except:
+                log.error('error waiting for prompt')
+                raise
+
     def prompt(self):
         '''wait for a prompt and return what comes before'''
         try:
-            self.con.expect(self._prompts)
+            with trace.span('expect'):
+                self.con.expect(self._prompts)
         except:
             log.error('error waiting for prompt')
             raise
 
         return self.con.before
 
+    def iter_peers(self):
+        '''
+        Yield peers as the router sends them
+
+        _peers_cmds lists (command, parser) pairs, preferred first. A parser
+        raises ValueError if the router does not support its command, then
+        the next one is tried and remembered for this session.
+        '''
+        while True:
+            cmd, parser = self._peers_cmds[self._peers_mode]
+            lines = self.lines(cmd)
+            try:
+                for peer in parser(lines):
+                    yield peer
+                return
+            except ValueError, e:
+                for line in lines:
+                    pass # read up to the prompt
+                if self._peers_mode + 1 == len(self._peers_cmds):
+                    raise
+                log.info('falling back from %r: %s', cmd, e)
+                self._peers_mode += 1
+
     def del_peer(self, group, ip):
         return self._del_peer.format(
                 our_asn=self._format_asn(self.our_asn),
@@ -171,59 +530,37 @@ class Juniper(Router):
         set authentication ssh-rsa "{pubkey}"
     '''
 
-    def connect(self):
-        self.prompt()
-        self.cmd('set cli screen-length 0')
-        self.cmd('set cli screen-width 0')
-
-    def peer_info(self, ip):
-        info = {}
-
-        info['ping'] = self.cmd('ping %s count 1 wait 1' % ip),
-        info['summary'] = self.cmd('show bgp neighbor %s | match "Peer:|Type:|messages:|Last"' % ip)
-        
+    _connect_prompt = True
+    _connect_cmds = [
+        'set cli screen-length 0',
+        'set cli screen-width 0',
+    ]
+    _peers_cmds = [
+        ('show bgp summary | display xml', parsers.junos_summary_xml),
+    ]
+    _hardware_cmd = 'show chassis hardware'
+    _config_cmd = 'show configuration | display set'
+    _config_revision_cmd = 'show system commit | match "^0 "'
+    _config_group_re = r'^set protocols bgp group (\S+)'
+
+    def _peer_info_cmds(self, ip):
         tolerant_ip = re.sub('::', ':[0:]*:', str(ip))
-       
-        info['config'] = self.cmd('show configuration | display set | match %s' % tolerant_ip)
-        info['log'] = self.cmd('show log bgp | match %s | last 10' % tolerant_ip)
-        info['log2'] = self.cmd('show log messages | match %s | last 10' % tolerant_ip)
-        return info
-   
-    def groups(self):
-        return self.cmd('show bgp group brief | match "Name: ."')
-       
-    def apply_config(self, conf):
+        return [
+            ('ping', 'ping %s count 1 wait 1' % ip),
+            ('summary', 'show bgp neighbor %s | match "Peer:|Type:|messages:|Last"' % ip),
+            ('config', NeighborConfig(ip)),
+            ('log', 'show log bgp | match %s | last 10' % tolerant_ip),
+            ('log2', 'show log messages | match %s | last 10' % tolerant_ip),
+        ]
+
+    def _apply_config(self, conf):
         self.cmd("conf")
         self.cmd(conf)
         self.con.sendline("commit and-quit")
         self.con.expect("commit complete", timeout=15)
         self.prompt()
 
-    def peers(self):
-        peers = []
-
-        self.con.sendline('show bgp summary | display xml')
-        self.con.expect('<rpc-reply.*</rpc-reply>')
-        xml = self.con.match.group()
-        xml = re.sub('xmlns="[^"]+"', '', xml)
-        self.prompt()
-        root = ET.fromstring(xml)
-        for node in root.findall('*/bgp-peer'):
-            peer = utils.Peer()
-            peer.ip = node.findtext('peer-address')
-            peer.asn = int(node.findtext('peer-as'))
-            peer.last_change = node.findtext('elapsed-time')
-            peer.state = node.findtext('peer-state')
-            
-            if node.findall('bgp-rib'):
-                peer.ver = 6 if 'inet6' in node.findtext('bgp-rib/name') else 4
-                peer.prefixes = node.findtext('bgp-rib/received-prefix-count')
-
-            peers.append(peer)
-    
-        return peers
-
-    def hardware(self):
+    def _parse_hardware(self, output):
         '''
         Example:
 
@@ -232,15 +569,12 @@ class Juniper(Router):
         Chassis                                J8025             M7I
         Midplane         REV 06   710-008761   AABH6555          M7i Midplane
         '''
-        self.con.sendline('show chassis hardware')
-        self.con.expect('Chassis\s+(\w+)\s+(\w+)')
-        info = {
+        m = _search('Chassis\s+(\w+)\s+(\w+)', output)
+        return {
             'vendor': 'Juniper',
-            'model': self.con.match.group(2),
-            'serial': self.con.match.group(1),
+            'model': m.group(2),
+            'serial': m.group(1),
         }
-        self.prompt()
-        return info
     
     def setup(self, enable_password=None):
         self.apply_config(self._setup.format(pubkey=config.PUBKEY.strip()))
@@ -252,7 +586,7 @@ class Juniper(Router):
 class Quagga(Router):
     _prompts = [
             '\n\S+#', # in vtysh: rrc05.ripe.net# 
-            '\n[^ ]*\[\S+@\S+ \S+\]#', # in shell: \x1b]0;...[root@rrc05 ~]#
+            '\n[^ \n]*\[\S+@\S+ \S+\]#', # in shell: \x1b]0;...[root@rrc05 ~]#
             ]
     _add_peer = '''
         router bgp {our_asn}
@@ -265,38 +599,33 @@ class Quagga(Router):
         router bgp {our_asn}
         no neighbor {c.ip}
     '''
-    def connect(self):
-        pass
-    
+    _peers_cmds = [
+        ('vtysh -c "show ip bgp summary json" -c "show bgp ipv6 unicast summary json"',
+            partial(parsers.frr_summary_json, afs=[ parsers.IPV4, parsers.IPV6 ])),
+        ('vtysh -c "show ip bgp summary" -c "show bgp ipv6 unicast summary"',
+            partial(parsers.cisco_summary, afs=[ parsers.IPV4, parsers.IPV6 ])),
+    ]
+    _config_cmd = 'vtysh -c "show running-config"'
+    _config_group_re = r'^\s*neighbor (\S+) peer-group$'
+    _config_context_re = r'address-family'
+
     def setup(self, enable_password):
         self.con.sendline('enable')
         self.con.expect('Password:')
         self.con.sendline(enable_password)
 
-    def peers(self):
-        peers = []
-        for line in self.cmd('vtysh -c "show ip bgp summary"').splitlines():
-            peers.append(parse_cisco_peer_summary_line(line))
-        
-        return filter(None, peers) 
-
-    def peer_info(self, ip):
-        info = {}
+    def _peer_info_cmds(self, ip):
         if ip.version == 6:
-            info['ping'] = self.cmd('ping6 -c1 -w1 %s' % ip)
+            ping = 'ping6 -c1 -w1 %s' % ip
         else:
-            info['ping'] = self.cmd('ping -c1 -w1 %s' % ip)
-        
-        info['summary'] = self.cmd('vtysh -c "show bgp neighbors %s" | egrep "BGP|Desc|Member|Last|Current|prefixes|family"' % ip)
-        
-        ip = str(ip).replace('::', ':[:0]*:')
-        info['config'] = self.cmd('vtysh -c "show running-config" | egrep "%s|address-family"' % ip)
-        return info
-
-    def groups(self):
-        return self.cmd('vtysh -c "show running-config" | egrep "peer-group$"')
-       
-    def apply_config(self, conf):
+            ping = 'ping -c1 -w1 %s' % ip
+        return [
+            ('ping', ping),
+            ('summary', 'vtysh -c "show bgp neighbors %s" | egrep "BGP|Desc|Member|Last|Current|prefixes|family"' % ip),
+            ('config', NeighborConfig(ip)),
+        ]
+
+    def _apply_config(self, conf):
         self.cmd("vtysh")
         self.cmd("conf terminal")
         self.cmd(conf)
@@ -304,7 +633,7 @@ class Quagga(Router):
         self.cmd("copy running-config startup-config")
         self.cmd("exit")
     
-    def hardware(self):
+    def _parse_hardware(self, output):
         return {
                 'vendor': 'Quagga',
                 'model': 'Linux',
@@ -344,29 +673,33 @@ class Cisco(Router):
         privilege exec all level 5 ping
     '''
     
-    def peers(self):
-        peers = []
-        for line in self.cmd('show ip bgp summary').splitlines():
-            peers.append(parse_cisco_peer_summary_line(line))
-        
-        return filter(None, peers) 
-
-    def connect(self): 
-        self.cmd('terminal length 0')
-        self.cmd('terminal no editing')
+    _connect_cmds = [
+        'terminal length 0',
+        'terminal no editing',
+    ]
+    _peers_cmds = [
+        ('show bgp all summary | json', parsers.nxos_summary_json), # NX-OS
+        ('show bgp all summary', parsers.cisco_summary),
+        ('show ip bgp summary', parsers.cisco_summary), # IOS before 12.2(33)
+    ]
+    _hardware_cmd = 'show inventory'
+    _config_cmd = 'show running-config'
+    # "| include" builds the whole running-config as well, so the TTL is used
+    _config_group_re = r'^\s*neighbor (\S+) peer-group$'
+    _config_context_re = r'^ address'
 
     def summary(self):
         info = {}
         info['addr'] = self.cmd('show config | i ipv*6* address')
         return info
         
-    def peer_info(self, ip):
-        info = {}
-        info['ping'] = self.cmd('ping %s repeat 1 timeout 1' % ip)
-        info['summary'] = self.cmd('show bgp ipv%s unicast neighbors %s | include BGP|Desc|Member|Last|Current' % (ip.version, str(ip).upper()))
-        info['config'] = self.cmd('show config | i %s|^ address' % str(ip).upper())
-        info['logs'] = self.cmd('show logging | i %s' % str(ip).upper())
-        return info
+    def _peer_info_cmds(self, ip):
+        return [
+            ('ping', 'ping %s repeat 1 timeout 1' % ip),
+            ('summary', 'show bgp ipv%s unicast neighbors %s | include BGP|Desc|Member|Last|Current' % (ip.version, str(ip).upper())),
+            ('config', NeighborConfig(ip)),
+            ('logs', 'show logging | i %s' % str(ip).upper()),
+        ]
 
     def setup(self, enable_password):
         self.con.sendline('enable')
@@ -379,7 +712,7 @@ class Cisco(Router):
         self.con.sendline('exit')
         self.con.expect(pexpect.EOF)
 
-    def apply_config(self, conf):
+    def _apply_config(self, conf):
         self.cmd('configure terminal')
         self.cmd(conf)
         self.con.sendcontrol('z')
@@ -389,26 +722,20 @@ class Cisco(Router):
         self.con.sendline('')
         self.con.expect('OK')
         self.prompt()
-    
-    def groups(self):
-        return self.cmd('show config | i peer-group$')
-    
-    def hardware(self):
+
+    def _parse_hardware(self, output):
         '''
         Example:
 
         NAME: "Chassis", DESCR: "Cisco 7301 single-slot chassis"
         PID: Cisco7301         , VID:    , SN: 74852456
         '''
-        self.con.sendline('show inventory')
-        self.con.expect('PID: (\w*) *, VID: .*, SN: (\w+)')
-        info = {
+        m = _search('PID: (\w*) *, VID: .*, SN: (\w+)', output)
+        return {
             'vendor': 'Cisco',
-            'model': self.con.match.group(1),
-            'serial': self.con.match.group(2),
+            'model': m.group(1),
+            'serial': m.group(2),
         }
-        self.prompt()
-        return info
 
     def _format_asn(self, asn):
         if asn > 65536:
@@ -416,35 +743,41 @@ class Cisco(Router):
         else:
             return str(asn)
 
-def parse_cisco_peer_summary_line(line):
+class NeighborConfig:
     '''
-    Example:
-    
-    Neighbor        V    AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd
-    12.0.1.63       4  7018 4336594   15901        0    0    0 02w0d16h   469820
-    '''
-    pattern = '''
-        ^([\d.]+)\s+  # Neighbor
-        (4|6)\s+      # version
-        ([\d.]+)\s+      # AS Number
-        (?:\d+\s+){5} # MsgRcvd, MsgSent, TblVer, InQ, OutQ
-        ([\w:]+)\s+      # last state change
-        (\w+)\s*$     # State/PfxRcd
+    A _peer_info_cmds entry answered from the config snapshot of the
+    router rather than by a command
     '''
-    m = re.match(pattern, line, re.VERBOSE)
-    if not m:
-        return
+    def __init__(self, ip):
+        self.ip = ip
 
-    peer = utils.Peer()
-    peer.ip = m.group(1)
-    peer.ver = m.group(2)
-    peer.asn = m.group(3)
-    peer.last_change = m.group(4)
-    try:
-        peer.prefixes = int(m.group(5))
-        peer.state = 'Established'
-    except ValueError:
-        peer.state = m.group(5)
-    
-    return peer
+    def __call__(self, router):
+        return router.neighbor_config(self.ip)
 
+def _join(lines):
+    return ''.join(line + '\n' for line in lines)
+
+def _help(handle, run):
+    '''run(session) on an idle session of handle, if there is one'''
+    try:
+        router = handle.checkout(wait=False, idle_only=True)
+    except Exception, e:
+        log.info('%s: no helping session: %s', handle.host, e)
+        return
+    if not router:
+        return
+    broken = False
+    try:
+        run(router)
+    except Exception, e:
+        log.info('%s: helping session failed: %s', handle.host, e)
+        broken = True
+    finally:
+        handle.checkin(router, broken)
+
+def _search(pattern, output):
+    '''Like re.search but fail loudly if the router said something unexpected'''
+    m = re.search(pattern, output)
+    if not m:
+        raise RuntimeError('unexpected output: %r' % output[-200:])
+    return m
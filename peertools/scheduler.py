@@ -0,0 +1,199 @@
+'''
+Background refresh scheduling for peerweb
+
+Every router is refreshed on its own interval by a bounded pool of worker
+threads. Routers which fail are retried with an exponential backoff.
+Refreshes requested by users are tracked as jobs which can be polled.
+'''
+
+import heapq, itertools, logging, random, threading, time, Queue
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class Job:
+    '''A set of router refreshes requested together'''
+    _ids = itertools.count(1)
+
+    def __init__(self, names):
+        self.id = next(Job._ids)
+        self.created = time.time() * 1000
+        self.finished = None
+        self.total = len(names)
+        self.pending = set(names)
+        self.failed = []
+
+    def complete(self, name, ok):
+        self.pending.discard(name)
+        if not ok:
+            self.failed.append(name)
+        if not self.pending and not self.finished:
+            self.finished = time.time() * 1000
+
+    def _json(self):
+        return {
+            'id': self.id,
+            'created': self.created,
+            'finished': self.finished,
+            'total': self.total,
+            'done': self.total - len(self.pending),
+            'failed': self.failed,
+            'pending': sorted(self.pending),
+        }
+
+class Scheduler:
+    '''Periodically refresh RouterData objects using a pool of workers'''
+
+    def __init__(self, routers, workers=8, interval=300, jitter=0.1,
+            retry=30, max_backoff=1800, keep_jobs=100):
+        self.routers = list(routers)
+        self.workers = workers
+        self.interval = interval
+        self.jitter = jitter
+        self.retry = retry
+        self.max_backoff = max_backoff
+        self.keep_jobs = keep_jobs
+
+        self._lock = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._due = {}        # name -> time of next refresh
+        self._failures = {}   # name -> consecutive failures
+        self._busy = set()
+        self._waiting = {}    # name -> jobs waiting for the next refresh
+        self._jobs = OrderedDict()
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        '''Stagger the first refreshes and start the threads'''
+        now = time.time()
+        with self._lock:
+            for router in self.routers:
+                spread = self._interval(router) * self.jitter
+                self._schedule(router, now + random.uniform(0, spread))
+
+        for i in range(self.workers):
+            self._spawn(self._work, 'refresh-worker-%d' % i)
+        self._spawn(self._run, 'refresh-scheduler')
+        log.info('scheduler started: %d routers, %d workers',
+                len(self.routers), self.workers)
+
+    def stop(self):
+        '''Stop the threads once the running refreshes are finished'''
+        with self._lock:
+            self._stopped = True
+            self._lock.notify()
+        for t in self._threads:
+            if t.name != 'refresh-scheduler':
+                self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _spawn(self, target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def submit(self, routers):
+        '''Refresh routers as soon as possible. Returns a Job'''
+        job = Job([r.name for r in routers])
+        now = time.time()
+
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.keep_jobs:
+                self._jobs.popitem(last=False)
+
+            for router in routers:
+                self._waiting.setdefault(router.name, []).append(job)
+                if router.name not in self._busy:
+                    self._schedule(router, now)
+            self._lock.notify()
+
+        if not routers:
+            job.finished = job.created
+        return job
+
+    def job(self, id):
+        with self._lock:
+            return self._jobs.get(id)
+
+    def status(self, router):
+        '''Scheduling information for one router'''
+        with self._lock:
+            return {
+                'due': self._due.get(router.name, 0) * 1000,
+                'failures': self._failures.get(router.name, 0),
+                'busy': router.name in self._busy,
+            }
+
+    def _interval(self, router):
+        return getattr(router, 'interval', None) or self.interval
+
+    def _schedule(self, router, when):
+        '''Must hold the lock. A later entry for the same router supersedes an earlier one'''
+        self._due[router.name] = when
+        heapq.heappush(self._heap, (when, next(self._seq), router))
+
+    def _next_delay(self, router, ok):
+        '''Seconds until the next refresh of router'''
+        if ok:
+            self._failures.pop(router.name, None)
+            delay = self._interval(router)
+        else:
+            failures = self._failures.get(router.name, 0) + 1
+            self._failures[router.name] = failures
+            delay = min(self.retry * 2 ** (failures - 1), self.max_backoff)
+
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _run(self):
+        '''Hand routers which are due to the workers'''
+        while True:
+            with self._lock:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._lock.wait(timeout)
+
+                when, _, router = heapq.heappop(self._heap)
+                if self._due.get(router.name) != when or router.name in self._busy:
+                    continue # stale entry
+                self._busy.add(router.name)
+                jobs = self._waiting.pop(router.name, [])
+
+            self._queue.put((router, jobs))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            router, jobs = item
+            try:
+                ok = router.refresh()
+            except Exception:
+                log.error('unexpected error refreshing %s', router.name, exc_info=True)
+                ok = False
+
+            with self._lock:
+                self._busy.discard(router.name)
+                for job in jobs:
+                    job.complete(router.name, ok)
+
+                delay = self._next_delay(router, ok)
+                if router.name in self._waiting:
+                    delay = 0 # requested while we were busy
+                if not ok and delay:
+                    log.warn('%s: retrying in %.0fs', router.name, delay)
+                self._schedule(router, time.time() + delay)
+                self._lock.notify()
@@ -0,0 +1,121 @@
+'''
+One OpenSSH master connection per router, shared by its sessions
+
+With SSH_MULTIPLEX a master is started on its own ("ssh -fNM") with a
+control socket in a private directory, before the first session of a
+router. Sessions open a channel on it instead of logging in again, which
+takes milliseconds and spares the TACACS/RADIUS servers the logins of a
+refresh. The master does not hold the pty of any session, so sessions
+close as before; without a master they log in directly.
+
+Dead masters are found with "ssh -O check" before a session is opened
+and started again, and all masters are stopped with "ssh -O exit" when
+the process exits.
+'''
+
+import atexit, logging, os, re, shutil, subprocess, tempfile, threading, time
+import pexpect
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_masters = {} # control path -> ControlMaster
+_directory = None
+
+def directory():
+    '''The directory of the control sockets, private to this process'''
+    global _directory
+    with _lock:
+        if _directory is None:
+            _directory = tempfile.mkdtemp(prefix='peertools-ssh-') # mode 0700
+            atexit.register(shutdown)
+        return _directory
+
+class ControlMaster:
+    '''The master connection to host, see ssh_config(5) ControlMaster'''
+    ssh = 'ssh'
+    retry = 60 # seconds before starting a master which failed again
+
+    def __init__(self, host, persist=600):
+        self.host = host
+        # socket paths are limited to about 100 characters
+        self.path = os.path.join(directory(), re.sub(r'[^\w.-]', '_', host)[:64])
+        self.persist = persist
+        self._lock = threading.Lock()
+        self._failed = 0
+        with _lock:
+            _masters[self.path] = self
+
+    def options(self):
+        '''The ssh options making a session use the master, but never start one'''
+        return [
+            '-oControlMaster=no',
+            '-oControlPath=%s' % self.path,
+        ]
+
+    def _control(self, command):
+        with open(os.devnull, 'w') as null:
+            return subprocess.call([ self.ssh, '-O', command, '-oControlPath=%s' % self.path,
+                self.host ], stdout=null, stderr=null) == 0
+
+    def ensure(self, password=None, timeout=30):
+        '''Whether the master is up, starting it if needed'''
+        with self._lock:
+            if self.check():
+                return True
+            if time.time() - self._failed < self.retry:
+                return False
+            try:
+                self.start(password, timeout)
+            except Exception, e:
+                log.warn('%s: cannot start ssh master: %s', self.host, e)
+            if self.check():
+                return True
+            self._failed = time.time()
+            return False
+
+    def start(self, password=None, timeout=30):
+        '''Log in with a master of its own, which goes to the background'''
+        log.info('%s: starting ssh master', self.host)
+        con = pexpect.spawn(self.ssh, [ '-fNM', '-oControlPath=%s' % self.path,
+            '-oControlPersist=%d' % self.persist, '-oProtocol=2,1', self.host ], timeout=timeout)
+        try:
+            if con.expect([ '[Pp]assword:', pexpect.EOF ]) == 0:
+                if not password:
+                    raise RuntimeError('password required but not supplied')
+                con.sendline(password)
+                con.expect(pexpect.EOF)
+        finally:
+            con.close(force=True)
+
+    def check(self):
+        '''Whether the master is up. A dead master's socket is removed'''
+        if not os.path.exists(self.path):
+            return False
+        if self._control('check'):
+            return True
+        log.info('%s: ssh master is gone', self.host)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        return False
+
+    def exit(self):
+        '''Stop the master, sessions using it are closed as well'''
+        if os.path.exists(self.path):
+            log.debug('%s: stopping ssh master', self.host)
+            self._control('exit')
+
+def shutdown():
+    '''Stop all masters of this process and remove their directory'''
+    with _lock:
+        masters = _masters.values()
+        _masters.clear()
+    for master in masters:
+        try:
+            master.exit()
+        except Exception, e:
+            log.warn('%s: cannot stop ssh master: %s', master.host, e)
+    if _directory:
+        shutil.rmtree(_directory, True)
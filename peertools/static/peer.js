@@ -1,7 +1,15 @@
 
+// Unlike the DataTables default this keeps the URL stable, so the browser
+// revalidates its copy with the ETag and gets a 304 when nothing changed
+function revalidate(sSource, aoData, fnCallback, oSettings) {
+    oSettings.jqXHR = jQuery.ajax(sSource, { "dataType": "json", "data": aoData })
+        .done(fnCallback);
+}
+
 function load_peers() {
     $('#peers table').dataTable({
         "bProcessing": true,
+        "bServerSide": true,
         "sAjaxSource": "api/peers",
         "sAjaxDataProp": "data",
         "sPaginationType": "full_numbers",
@@ -9,13 +17,24 @@ function load_peers() {
         "bStateSave": true,
         "aoColumns": [
             { "sTitle": "IPv", "mData": "ver" },
+            { "sTitle": "SAFI", "mData": "safi" },
             { "sTitle": "Router", "mData": "router" },
             { "sTitle": "IP", "mData": "ip" },
             { "sTitle": "ASN", "mData": "asn" },
             { "sTitle": "Prefixes", "mData": "prefixes" },
             { "sTitle": "State", "mData": "state" },
-            { "sTitle": "Last Change", "mData": "last_change" }
+            { "sTitle": "Last Change", "mData": "last_change" },
+            { "sTitle": "Participant", "mData": "pdb_name", "sDefaultContent": "",
+                "bSortable": false, "bSearchable": false },
+            { "sTitle": "Exchange", "mData": "pdb_exchange", "sDefaultContent": "",
+                "bSortable": false, "bSearchable": false }
         ],
+        "fnRowCallback": function(nRow, aData) {
+            if(aData.asn_mismatch) {
+                $(nRow).addClass('asn-mismatch')
+                    .attr('title', 'PeeringDB has AS' + aData.pdb_asn + ' for this address');
+            }
+        },
         "fnDrawCallback" : function() {
             $('#peers p.status span').text('loaded at ' + new Date());
         }
@@ -26,6 +45,7 @@ function load_routers() {
     $('#routers table').dataTable({
         "bProcessing": true,
         "sAjaxSource": "api/routers",
+        "fnServerData": revalidate,
         "sAjaxDataProp": "data",
         "sPaginationType": "full_numbers",
         "bJQueryUI": false,
@@ -63,24 +83,46 @@ function refresh() {
         return;
     }
 
+    var job = null;
     g_progress = setInterval(function() {
         var dur = new Date().getTime() - start;
+        var done = job ? ' (' + job.done + '/' + job.total + ' routers)' : '';
         $('#refresh_status').text(
-            'refreshing for ' + (dur / 1000) + ' seconds'); 
+            'refreshing for ' + (dur / 1000) + ' seconds' + done); 
     }, 100);
 
-    jQuery.ajax("api/refresh", {
-        "cache": false,
-    })
-    .always(function() {
+    function finish(text) {
         clearInterval(g_progress);
         g_progress = null;
+        $('#refresh_status').text(text);
+    }
+
+    function poll() {
+        jQuery.ajax("api/job/" + job.id, { "cache": false })
+        .done(function(data) {
+            job = data;
+            if(job.finished == null) {
+                setTimeout(poll, 500);
+            } else if(job.failed.length) {
+                finish('refreshed at ' + new Date() + ', failed: ' + job.failed.join(', '));
+            } else {
+                finish('refreshed at ' + new Date());
+            }
+        })
+        .fail(function(jqXHR, textStatus, errorThrown) {
+            finish('ERROR refreshing');
+        });
+    }
+
+    jQuery.ajax("api/refresh", {
+        "cache": false,
     })
     .done(function(data) {
-        $('#refresh_status').text('refreshed at ' + new Date());
+        job = data;
+        poll();
     })
     .fail(function(jqXHR, textStatus, errorThrown) {
-        $('#refresh_status').text('ERROR refreshing');
+        finish('ERROR refreshing');
     });
 }
 
@@ -92,39 +134,142 @@ function look() {
             'running for ' + (dur / 1000) + ' seconds'); 
     }, 100);
 
-    var url = "api/look/" + $('#host').val() + "/" + $('#cmd').val();
-    jQuery.ajax(url)
-        .done(function(data) {
-            $('#look textarea').empty();
-            
-            $.each(data.results, function(host, lines) {
-                $.each(lines.split("\n"), function(_i, line) {
-                    $('#look textarea').append("[" + host + "] " + line + "\n");
-                })
+    var textarea = $('#look textarea');
+    textarea.empty();
+
+    function show(result) {
+        var text = '';
+        if(result.error) {
+            text = "[" + result.host + "] ERROR: " + result.error + "\n";
+        } else {
+            $.each(result.output.split("\n"), function(_i, line) {
+                text += "[" + result.host + "] " + line + "\n";
             });
-            
-            clearInterval(progress);
-            $('#look_status').text('done at ' + new Date());
-        })
-        .fail(function(jqXHR, textStatus, errorThrown) {
-            clearInterval(progress);
-            $('#look_status').text('ERROR');
+        }
+        textarea.append(document.createTextNode(text));
+    }
+
+    // results arrive as one JSON object per line, as each router answers
+    var url = "api/look/" + $('#host').val() + "/" + $('#cmd').val();
+    var xhr = new XMLHttpRequest();
+    var seen = 0;
+    var done = null;
+
+    function read() {
+        var lines = xhr.responseText.substring(seen).split("\n");
+        lines.pop(); // incomplete
+        $.each(lines, function(_i, line) {
+            seen += line.length + 1;
+            var result = JSON.parse(line);
+            if(result.done)
+                done = result;
+            else
+                show(result);
         });
+    }
+
+    xhr.onprogress = read;
+    xhr.onload = function() {
+        read();
+        clearInterval(progress);
+        if(xhr.status != 200 || done == null) {
+            $('#look_status').text('ERROR');
+        } else {
+            var failed = done.failed ? ', ' + done.failed + ' failed' : '';
+            $('#look_status').text('done at ' + new Date() + ' (' +
+                done.routers + ' routers' + failed + ')');
+        }
+    };
+    xhr.onerror = function() {
+        clearInterval(progress);
+        $('#look_status').text('ERROR');
+    };
+    xhr.open("GET", url);
+    xhr.send();
+}
+
+var g_routers = {};
+
+function show_status() {
+    $('#quick tbody').html('');
+    $.each(Object.keys(g_routers).sort(), function(_index, name) {
+        var router = g_routers[name];
+        $('#quick tbody').append('<tr><td>' + router.name + '</td><td>' + router.state + '</td></tr>');
+    });
 }
 
 function reload_status() {
-    jQuery.ajax("api/routers", { cache: false })
+    jQuery.ajax("api/routers")
         .done(function(data) {
-            $('#quick tbody').html('');
-            
+            g_routers = {};
             $.each(data.data, function(_index, router) {
-                $('#quick tbody').append('<tr><td>' + router.name + '</td><td>' + router.state + '</td></tr>');
+                g_routers[router.name] = router;
             });
+            show_status();
         })
         .fail(function(jqXHR, textStatus, errorThrown) {
             $('#quick tbody').html('');
         });
+}
+
+var g_redraw = null;
+
+function apply_change(change) {
+    if(change.type == 'router') {
+        g_routers[change.router.name] = change.router;
+        show_status();
+    } else if(change.type == 'refresh' && g_redraw == null) {
+        // a refresh of the whole fleet finishes many routers at once
+        g_redraw = setTimeout(function() {
+            g_redraw = null;
+            $('#routers table').dataTable().fnReloadAjax();
+            $('#peers table').dataTable().fnDraw(false);
+        }, 2000);
+    }
+}
+
+// Follow the changes pushed by peerweb, with Server-Sent Events where the
+// browser has them and peerweb has a thread to spare, long-polling
+// otherwise. Subscribe before loading the full status, so nothing is
+// missed in between.
+function follow() {
+    if(window.EventSource) {
+        var source = new EventSource("api/stream");
+        $.each(['router', 'refresh', 'event'], function(_i, type) {
+            source.addEventListener(type, function(e) {
+                apply_change(JSON.parse(e.data));
+            });
+        });
+        source.addEventListener('reset', reload_status);
+        source.addEventListener('error', function() {
+            // closed for good: peerweb answered 503, too many streams
+            if(source.readyState == EventSource.CLOSED)
+                long_poll();
+        });
+        reload_status();
+        return;
+    }
+    long_poll();
+}
 
+function long_poll() {
+    var seq = null;
+    function poll() {
+        jQuery.ajax("api/changes", { "cache": false, "data": seq == null ? {} : { "since": seq } })
+            .done(function(data) {
+                if(seq == null || data.reset)
+                    reload_status();
+                $.each(data.changes, function(_i, change) {
+                    apply_change(change);
+                });
+                seq = data.seq;
+                poll();
+            })
+            .fail(function() {
+                setTimeout(poll, 3000);
+            });
+    }
+    poll();
 }
 
 function setup() {
@@ -132,10 +277,10 @@ function setup() {
         $('#routers table').dataTable().fnReloadAjax();
     });
     $('#peers a.reload').click(function() {
-        $('#peers table').dataTable().fnReloadAjax();
+        $('#peers table').dataTable().fnDraw(false);
     });
     $('#refresh').click(refresh);
-    setInterval(reload_status, 1000);
+    follow();
 }
 
 $(document).ready(function() {
@@ -1,8 +1,784 @@
 
-from web_utils import RouterData
-from nose.tools import eq_
+import gzip, json, os, shutil, subprocess, sys, tempfile, threading, time
+from cStringIO import StringIO
+import pexpect
+
+from web_utils import ChangeLog, PeerStore, RouterData, Snapshot, fan_out
+from scheduler import Scheduler
+from routers import RouterHandle
+import aio, batch, confcache, events, fakerouter, fleet, history, ipindex, metrics, parsers, peeringdb, routers, sshmux, trace, warmstart
+from nose.tools import eq_, raises
 
 def test_router_data_json():
     rd = RouterData('fake')
     eq_({'peers': 0, 'host': 'fake', 'state': 'uninitiated', 'error': None}, rd._json())
 
+
+class FakeRouterData:
+    def __init__(self, name, ok=True):
+        self.name = name
+        self.ok = ok
+        self.refreshed = 0
+
+    def refresh(self):
+        self.refreshed += 1
+        return self.ok
+
+def test_scheduler_job():
+    good, bad = FakeRouterData('good'), FakeRouterData('bad', ok=False)
+    s = Scheduler([good, bad], workers=2, interval=3600)
+    s.start()
+    job = s.submit([good, bad])
+    for i in range(100):
+        if job.finished:
+            break
+        time.sleep(0.01)
+    s.stop()
+
+    eq_(2, job._json()['done'])
+    eq_(['bad'], job.failed)
+    eq_(job, s.job(job.id))
+
+def test_scheduler_backoff():
+    bad = FakeRouterData('bad', ok=False)
+    s = Scheduler([bad], interval=3600, jitter=0, retry=10, max_backoff=35)
+    eq_([10, 20, 35, 35], [s._next_delay(bad, False) for i in range(4)])
+    eq_(3600, s._next_delay(bad, True))
+
+class FakeSession:
+    def __init__(self):
+        self.con = self
+        self.pipe = self
+        self.closed = False
+
+    def cmd(self, cmd):
+        return ''
+
+    def close(self, force=False):
+        self.closed = True
+
+    def clear(self):
+        pass
+
+class FakeHandle(RouterHandle):
+    def _connect(self):
+        return FakeSession()
+
+def test_pool_reuse():
+    handle = FakeHandle('fake', 1, sessions=2)
+    with handle as a:
+        with handle as b:
+            assert a is not b
+    with handle as c:
+        assert c is a # most recently returned
+    eq_(2, handle._open)
+
+def test_pool_broken_session():
+    handle = FakeHandle('fake', 1, sessions=1)
+    try:
+        with handle as a:
+            raise RuntimeError('lost')
+    except RuntimeError:
+        pass
+    assert a.closed
+    eq_('lost', handle.error)
+    with handle as b:
+        assert b is not a
+
+FAKEROUTER = [ sys.executable, os.path.join(os.path.dirname(__file__), 'fakerouter.py') ]
+
+def fake_command(vendor, *args):
+    return FAKEROUTER + [ '--vendor', vendor ] + list(args)
+
+def test_router_handle_dialects():
+    for vendor, count in [ ('juniper', 8), ('cisco', 8), ('quagga', 8) ]:
+        handle = RouterHandle(vendor, 1, 'secret', command=fake_command(vendor, '--peers', '8'))
+        with handle as router:
+            eq_(count, len(router.peers()))
+            eq_(vendor, router.hardware()['vendor'].lower())
+
+def test_aio_poll():
+    handles = [ aio.AsyncHandle(vendor, 1, 'secret', command=fake_command(vendor))
+            for vendor in ('juniper', 'cisco', 'quagga') ]
+    results = aio.poll(handles, concurrency=2)
+    eq_(10, len(results['juniper']['peers']))
+    eq_('Cisco', results['cisco']['hardware']['vendor'])
+    eq_('Established', results['quagga']['peers'][0].state)
+
+def test_aio_peer_info():
+    handle = aio.AsyncHandle('juniper', 1, command=fake_command('juniper', '--peers', '8'))
+    results = aio.poll([ handle ], lambda router: router.peer_info('10.0.0.1'))
+    eq_([ 'config', 'log', 'log2', 'ping', 'summary' ], sorted(results['juniper']))
+    eq_('set protocols bgp group peers neighbor 10.0.0.1 description "AS64513"\n'
+        'set protocols bgp group peers neighbor 10.0.0.1 peer-as 64513\n', results['juniper']['config'])
+
+def test_aio_timeout():
+    handle = aio.AsyncHandle('slow', 1, command=fake_command('juniper', '--latency', '5'), timeout=0.5)
+    results = aio.poll([handle])
+    assert isinstance(results['slow'], pexpect.TIMEOUT)
+    eq_('TIMEOUT', handle.error)
+
+def test_router_stream():
+    handle = RouterHandle('cisco', 1, 'secret', command=fake_command('cisco', '--peers', '8'))
+    with handle as router:
+        peers = list(router.iter_peers())
+        eq_(8, len(peers))
+        chunks = list(router.stream('show inventory\nping 10.0.0.1'))
+        assert len(chunks) > 1
+        assert 'SN: 74852456' in ''.join(chunks)
+        assert 'Success rate' in ''.join(chunks)
+        assert 'SN: 74852456' in router.cmd('show inventory')
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read().splitlines()
+
+def check_fixture(name, parser, count, first):
+    peers = list(parser(fixture(name)))
+    eq_(count, len(peers))
+    eq_(dict(first, router=None), peers[0]._json())
+
+def test_parser_fixtures():
+    for name, parser, count, first in [
+        ('ios_summary.txt', parsers.cisco_summary, 5,
+            dict(ip='12.0.1.63', ver=4, asn=7018, last_change='02w0d16h', state='Established', prefixes=469820, afi='ipv4', safi='unicast')),
+        ('ios_summary_ipv6.txt', parsers.cisco_summary, 4,
+            dict(ip='2001:7F8:1::A500:6777:1', ver=6, asn=6777, last_change='9w5d', state='Established', prefixes=2, afi='ipv6', safi='unicast')),
+        ('quagga_summary.txt', parsers.cisco_summary, 4,
+            dict(ip='80.81.192.2', ver=4, asn=6695, last_change='3d12h08m', state='Established', prefixes=469281, afi='ipv4', safi='unicast')),
+        ('quagga_summary.json', parsers.frr_summary_json, 3,
+            dict(ip='80.81.192.2', ver=4, asn=6695, last_change='3d12h08m', state='Established', prefixes=469281, afi='ipv4', safi='unicast')),
+        ('frr_summary.json', parsers.frr_summary_json, 3,
+            dict(ip='80.81.192.2', ver=4, asn=6695, last_change='3d12h08m', state='Established', prefixes=469281, afi='ipv4', safi='unicast')),
+        ('nxos_summary.json', parsers.nxos_summary_json, 3,
+            dict(ip='192.0.2.1', ver=4, asn=64496, last_change='1w2d', state='Established', prefixes=900, afi='ipv4', safi='unicast')),
+        ('junos_summary.xml', parsers.junos_summary_xml, 3,
+            dict(ip='193.0.0.1', ver=4, asn=3333, last_change='4w5d 0:33:36', state='Established', prefixes=512034, afi='ipv4', safi='unicast')),
+        ]:
+        yield check_fixture, name, parser, count, first
+
+def test_parser_states():
+    peers = list(parsers.cisco_summary(fixture('ios_summary.txt')))
+    eq_(['Established', 'Established', 'Idle (Admin)', 'Established', 'Active'], [p.state for p in peers])
+    eq_(65546, peers[2].asn)
+    eq_(None, peers[2].prefixes)
+
+def test_parser_address_families():
+    def families(peers):
+        return [ (p.ip, p.afi, p.safi) for p in peers ]
+
+    eq_([ ('80.249.208.1', 'ipv4', 'unicast'), ('193.0.0.99', 'ipv4', 'unicast'),
+          ('2001:7F8:1::A500:6777:1', 'ipv6', 'unicast'), ('193.0.0.99', 'ipv6', 'unicast'),
+          ('80.249.208.1', 'ipv4', 'multicast') ],
+        families(parsers.cisco_summary(fixture('ios_bgp_all_summary.txt'))))
+
+    afs = [ parsers.IPV4, parsers.IPV6 ]
+    peers = list(parsers.cisco_summary(fixture('quagga_summary_all.txt'), afs))
+    eq_([ 'ipv4', 'ipv4', 'ipv6', 'ipv6' ], [ p.afi for p in peers ])
+    eq_(6, peers[3].ver) # IPv6 routes over an IPv4 session
+
+    eq_([ 'ipv4', 'ipv4', 'ipv6' ], [ p.afi for p in parsers.frr_summary_json(fixture('frr_summary.json')) ])
+
+@raises(ValueError)
+def test_parser_unsupported():
+    list(parsers.nxos_summary_json(fixture('ios_invalid_json.txt')))
+
+def test_peers_fallback():
+    for vendor, structured in [ ('cisco', False), ('cisco', True), ('quagga', False), ('quagga', True) ]:
+        args = [ '--json' ] if structured else []
+        handle = RouterHandle(vendor, 1, 'secret', command=fake_command(vendor, *args))
+        with handle as router:
+            peers = router.peers()
+            eq_(10, len(peers))
+            eq_(2, len([ p for p in peers if p.afi == 'ipv6' ]))
+            eq_(0 if structured else 1, router._peers_mode)
+
+def test_peer_store():
+    store = PeerStore()
+    output = fixture('ios_summary.txt')
+    store.replace('r1', list(parsers.cisco_summary(output)))
+    store.replace('r2', list(parsers.cisco_summary(output)))
+    count = len(store.get('r1'))
+    eq_(2 * count, len(store))
+
+    a, b = store.get('r1')[0], store.get('r2')[0]
+    eq_(('r1', 'r2'), (a.router, b.router))
+    assert a.state is b.state and a.asn is b.asn
+
+    store.replace('r1', [])
+    eq_(count, len(store.all()))
+    eq_(store.get('r2'), tuple(store.all(['r1', 'r2'])))
+
+def test_snapshot():
+    snap = Snapshot()
+    snap.update('r1', [ { 'a': 1 } ])
+    snap.update('r2', [])
+    etag, body, gzipped = snap.render(['r1', 'r2'])
+    eq_({ 'data': [ { 'a': 1 } ] }, json.loads(body))
+    eq_(body, gzip.GzipFile(fileobj=StringIO(gzipped)).read())
+    eq_(etag, snap.render(['r1', 'r2'])[0])
+    assert etag != snap.render(['r1'])[0]
+
+    snap.update('r2', [ { 'b': 2 } ])
+    etag2, body, _ = snap.render(['r1', 'r2'])
+    assert etag2 != etag
+    eq_(2, len(json.loads(body)['data']))
+
+def test_peer_store_query():
+    store = PeerStore()
+    table = fakerouter.Table(400)
+    output = (table.cisco(4) + table.cisco(6)).splitlines()
+    store.replace('r1', list(parsers.cisco_summary(output)))
+    store.replace('r2', list(parsers.cisco_summary(output)))
+    routers = ['r1', 'r2']
+
+    total, matched, page = store.query(routers, start=10, length=5)
+    eq_((800, 800, 5), (total, matched, len(page)))
+
+    total, matched, page = store.query(routers, 'AS64513 r2')
+    eq_([('r2', 64513)], [ (p.router, p.asn) for p in page ])
+
+    matched, page = store.query(routers, '10.0.1.0/24 established')[1:]
+    eq_(set(['10.0.1.%d' % i for i in range(256) if i % 4 != 3]) & set(p.ip for p in page),
+        set(p.ip for p in page))
+    assert all(p.state == 'Established' for p in page) and matched
+
+    eq_(2, store.query(routers, '2001:db8::4')[1])
+    eq_(2 * 63, store.query(routers, columns={ 'ip': '2001:db8::/120' })[1])
+
+    page = store.query(routers, sort='asn', reverse=True, length=3)[2]
+    eq_([64911, 64911, 64910], [ p.asn for p in page ])
+    page = store.query(routers, sort='ip', start=799)[2]
+    eq_('2001:db8::190', page[0].ip)
+
+def test_change_log():
+    log = ChangeLog(size=3)
+    eq_(([], False), log.wait(0, 0))
+    for i in range(5):
+        log.append('router', name=i)
+    eq_(([], True), log.since(0))
+    eq_(([], True), log.since(6))
+    changes, reset = log.since(3)
+    eq_([3, 4], [ c['name'] for c in changes ])
+    eq_('router', changes[0]['type'])
+
+def test_peer_store_changes():
+    store = PeerStore()
+    peers = list(parsers.cisco_summary(fixture('ios_summary.txt')))
+    store.replace('r1', peers)
+    eq_(0, store.changes.seq)
+
+    peers = list(parsers.cisco_summary(fixture('ios_summary.txt')))
+    gone, flapped = peers.pop(), peers[0]
+    flapped.state, flapped.prefixes = 'Idle', None
+    store.replace('r1', peers)
+    changes = store.changes.since(0)[0]
+    eq_(['event', 'event'], [ c['type'] for c in changes ])
+    eq_([flapped.ip, gone.ip], [ c['event'].ip for c in changes ])
+    eq_([ c['event'] for c in changes ], store.events.recent()[::-1])
+
+def test_fan_out():
+    def run(delay):
+        if delay < 0:
+            raise ValueError('negative')
+        time.sleep(delay)
+        return delay
+
+    start = time.time()
+    results = list(fan_out([5, 0.2, 0, -1, 0.1], run, concurrency=2, timeout=0.5))
+    assert time.time() - start < 1.5
+    eq_([(0.2, 0.2, None), (0, 0, None), (-1, None, 'ValueError: negative'),
+        (0.1, 0.1, None), (5, None, 'timeout')], results)
+
+def test_uptime_seconds():
+    for text, seconds in [
+            ('02w0d16h', 14 * 86400 + 16 * 3600),
+            ('1d02h', 93600),
+            ('00:12:34', 754),
+            ('1w2d 3:04:05', 9 * 86400 + 11045),
+            ('5:07', 307),
+            ('never', None),
+            (None, None),
+            ]:
+        eq_(seconds, history.uptime_seconds(text))
+
+def test_history():
+    h = history.History(':memory:', retention=1)
+    peers = list(parsers.cisco_summary(fixture('ios_summary.txt')))
+    count = len(peers)
+    eq_(count, h.record('r1', peers, now=1000))
+    eq_(0, h.record('r1', peers, now=1100))
+
+    flapped = peers[0]
+    flapped.last_change = '00:00:10'
+    gone = peers.pop()
+    eq_(2, h.record('r1', peers, now=1200))
+    rows = h.peer('r1', flapped.ip)
+    eq_([1200, 1000], [ r['time'] for r in rows ])
+    eq_(None, h.peer('r1', gone.ip)[0]['state'])
+    eq_(1, len(h.asn(flapped.asn, since=1100)))
+
+    # a restart picks up where it left off, old rows are pruned
+    h._last = h._load()
+    eq_(count - 1, len(h._last['r1']))
+    h.record('r1', peers, now=1000 + 86400 + 1)
+    eq_([1200], [ r['time'] for r in h.peer('r1', flapped.ip) ])
+
+def test_events_diff():
+    output = fakerouter.Table(40).cisco().splitlines()
+    old = list(parsers.cisco_summary(output))
+    new = list(parsers.cisco_summary(output))
+    removed = new.pop(-1)
+    added = old.pop(0)
+    up = [ p for p in new[1:] if p.state == 'Established' ]
+    up[0].state, up[0].prefixes = 'Active', None
+    up[1].prefixes += 100
+    up[2].prefixes += 99
+    up[3].last_change = '00:00:05'
+
+    changes = events.diff('r1', old, new)
+    eq_([events.NEIGHBOR_ADDED, events.SESSION_DOWN, events.PREFIX_DELTA,
+            events.SESSION_FLAP, events.NEIGHBOR_REMOVED],
+        [ e.type for e in changes ])
+    eq_(('Established', 'Active'), (changes[1].old, changes[1].new))
+    eq_((added.ip, removed.ip), (changes[0].ip, changes[4].ip))
+    eq_([events.SESSION_UP], [ e.type for e in events.diff('r1', new, old) if e.ip == up[0].ip ])
+
+    written = []
+    log = events.EventLog(size=3, sinks=[ written.extend ])
+    log.publish(changes)
+    eq_(changes, written)
+    eq_([5, 4, 3], [ e.id for e in log.recent() ])
+    eq_([5], [ e.id for e in log.recent(since=4) ])
+    eq_([4], [ e.id for e in log.recent(type=events.SESSION_FLAP) ])
+
+def test_metrics():
+    m = metrics.Metrics(buckets=(1, 10))
+    m.refreshed('r1', 2.5, True, when=1000)
+    m.refreshed('r1', 0.5, False, 'TIMEOUT')
+    m.refreshed('r1', 0.5, False, 'TIMEOUT')
+    m.sessions('r"1', list(parsers.cisco_summary(fixture('ios_summary.txt')))[:2])
+    body = m.render()
+    lines = body.splitlines()
+
+    for line in [
+            'peertools_refresh_duration_seconds_bucket{le="1",router="r1"} 2',
+            'peertools_refresh_duration_seconds_bucket{le="10",router="r1"} 3',
+            'peertools_refresh_duration_seconds_bucket{le="+Inf",router="r1"} 3',
+            'peertools_refresh_duration_seconds_sum{router="r1"} 3.5',
+            'peertools_refresh_errors_total{error="TIMEOUT",router="r1"} 2',
+            'peertools_last_success_timestamp_seconds{router="r1"} 1000.0',
+            'peertools_router_peers{router="r\\"1"} 2',
+            'peertools_session_up{afi="ipv4",asn="7018",ip="12.0.1.63",router="r\\"1",safi="unicast"} 1',
+            ]:
+        assert line in lines, line
+    eq_(1, lines.count('# TYPE peertools_session_up gauge'))
+    eq_(body, gzip.GzipFile(fileobj=StringIO(m.render(compress=True))).read())
+    assert m.render() is body
+
+def test_trace_refresh():
+    timings = trace.Timings()
+    handle = RouterHandle('traced', 1, command=fake_command('juniper', '--peers', '8'))
+    with trace.collect('traced', timings):
+        with handle as router:
+            router.peers()
+    eq_(None, trace.current())
+
+    result = timings._json('traced')
+    spans = result['routers']['traced']['spans']
+    eq_('Juniper', result['routers']['traced']['vendor'])
+    for name in ('refresh', 'checkout', 'spawn', 'login', 'setup', 'expect', 'peers', 'cmd'):
+        assert name in spans, name
+    eq_(3, spans['cmd']['count']) # two in setup, one for the peers
+    assert spans['cmd']['bytes'] > 8 * 200 and spans['cmd']['wait'] > 0
+    eq_(spans, result['vendors']['Juniper'])
+    eq_(trace._null, trace.span('untraced'))
+
+    with trace.collect('traced', timings):
+        with handle as router:
+            router.apply_config('set system host-name fake\nset snmp community secret')
+            router.groups()
+    handle.close()
+    last = json.dumps(timings._json('traced')['routers']['traced']['last'])
+    assert 'set system host-name fake' in last
+    assert 'secret' not in last and 'peer-as' not in last, 'config text in the trace'
+
+def test_router_data_shared_store():
+    store = PeerStore()
+    fleet = [ RouterData(RouterHandle(vendor, 1, 'secret',
+        command=fake_command(vendor, '--peers', '5')), store) for vendor in ('juniper', 'cisco') ]
+    for router in fleet:
+        assert router.refresh(), router.state
+        router.handle.close()
+    eq_(10, len(store))
+    eq_(5, len(fleet[0].peers))
+
+def test_bench_compare():
+    import bench
+    table, regressed = bench.compare({ 'parse x records/s': 50.0, 'query y ms': 1.1, 'new ms': 1 },
+            { 'parse x records/s': 100.0, 'query y ms': 1.0 }, 0.2)
+    eq_([ 'parse x records/s' ], regressed)
+
+def test_read_manifest():
+    changes = batch.read_manifest(StringIO('router,ip,asn,group,desc\n'
+        'r1,192.0.2.1,64500,peers,Example\nr2,2001:db8::1,64500,peers6,Example\nr1, 192.0.2.2 ,64501,peers,Other\n'))
+    eq_([ 'r1', 'r2' ], changes.keys())
+    eq_([ '192.0.2.1', '192.0.2.2' ], [ str(c.ip) for c in changes['r1'] ])
+    eq_(64501, changes['r1'][1].asn)
+    changes = batch.read_manifest(StringIO('router,ip,group\nr2,2001:db8::1,peers6\n'), 'delpeer')
+    eq_((None, 'peers6', None), (changes['r2'][0].asn, changes['r2'][0].group, changes['r2'][0].desc))
+
+@raises(ValueError)
+def test_read_manifest_bad_ip():
+    batch.read_manifest(StringIO('router,ip,group\nr1,192.0.2,peers\n'), 'delpeer')
+
+def test_read_manifest_required():
+    for cmd, manifest in [
+            ('addpeer', 'router,ip,asn,group\n'),
+            ('addpeer', 'router,ip,asn,group,desc\nr1,192.0.2.1,64500,peers,Example\nr1,192.0.2.2,64500,,Example\n'),
+            ('addpeer', 'router,ip,asn,group,desc\nr1,192.0.2.1,,peers,Example\n'),
+            ('delpeer', 'router,ip,group\nr1,192.0.2.1, \n')]:
+        try:
+            batch.read_manifest(StringIO(manifest), cmd)
+            assert False, 'accepted %r' % manifest
+        except ValueError, e:
+            assert 'lacks' in str(e) or 'manifest line' in str(e), e
+    try:
+        batch.read_manifest(StringIO('router,ip,asn,group,desc\nr1,192.0.2.1,64500,peers,Example\n'
+            'r1,192.0.2.2,64500,,Example\n'))
+        assert False, 'accepted a peer without a group'
+    except ValueError, e:
+        eq_('manifest line 3: no group', str(e))
+
+def test_deployment():
+    changes = batch.read_manifest(StringIO('router,ip,asn,group,desc\n'
+        'juniper,10.0.0.1,64500,peers,Example\njuniper,192.0.2.1,64500,peers,Example\n'
+        'broken,192.0.2.1,64500,peers,Example\n'))
+    def handle(router):
+        return RouterHandle(router, 1, command=fake_command(router, '--peers', '4'))
+    deployment = batch.Deployment(changes, 'addpeer', handle, concurrency=2)
+    try:
+        deployment.prepare()
+        eq_('failed', deployment.results['broken'].state)
+        juniper = deployment.results['juniper']
+        eq_([ '10.0.0.1 is configured already' ], juniper.warnings)
+        eq_(2, juniper.config.count('set peer-as 64500'))
+        assert 'neighbor 192.0.2.1' in deployment.diff()
+
+        deployment.apply()
+        eq_('applied', juniper.state)
+        assert not deployment.ok()
+    finally:
+        deployment.close()
+
+def test_peeringdb_snapshot():
+    tmp = tempfile.mkdtemp()
+    try:
+        remote = 'sqlite:///%s/remote.db' % tmp
+        engine = peeringdb.create_engine(remote)
+        peeringdb.Base.metadata.create_all(engine)
+        engine.execute(peeringdb.Peer.__table__.insert(), [
+            dict(id=1, asn=3333, name='RIPE NCC'), dict(id=2, asn=13333, name='Example Networks') ])
+
+        path = os.path.join(tmp, 'snapshot.db')
+        eq_(2, peeringdb.sync(remote, path)['peerParticipants'])
+        eq_(0, peeringdb.sync(remote, path)['peerParticipants'])
+        engine.execute("UPDATE peerParticipants SET name = 'Example Net' WHERE id = 2")
+        eq_(1, peeringdb.sync(remote, path)['peerParticipants'])
+
+        peeringdb.init(remote, False, path)
+        def search(words):
+            query = peeringdb.db.query(peeringdb.Peer)
+            return [ p.asn for p in query.filter(peeringdb._search(peeringdb.Peer, words)) ]
+        eq_([ 3333 ], search('ripe'))
+        eq_([ 13333 ], search('exam net'))
+        eq_([], search('networks'))
+    finally:
+        peeringdb.db, peeringdb.snapshot = None, None
+        shutil.rmtree(tmp)
+
+def peeringdb_fixture():
+    '''An in-memory PeeringDB of two peers meeting at 10 exchanges'''
+    peeringdb.init('sqlite://', False)
+    peeringdb.Base.metadata.create_all(peeringdb.db.get_bind())
+    peeringdb.db.add_all([ peeringdb.Exchange(id=i, name='IX%d' % i, tech_email='tech@ix%d' % i)
+        for i in range(10) ])
+    peeringdb.db.add_all([ peeringdb.Peer(id=1, asn=3333, name='RIPE NCC'),
+        peeringdb.Peer(id=2, asn=64500, name='Example') ])
+    peeringdb.db.add_all([ peeringdb.Router(id=i, peer_id=1 + i % 2, public_id=i // 4,
+        addr='192.0.2.%d' % i if i % 4 < 2 else '2001:db8::%d' % i) for i in range(40) ])
+    peeringdb.db.add_all([ peeringdb.Contact(id=i, peer_id=1 + i % 2, name='noc%d' % i)
+        for i in range(10) ])
+    peeringdb.db.commit()
+
+def test_peeringdb_query_counts():
+    from sqlalchemy import event
+    peeringdb_fixture()
+    statements = []
+    event.listen(peeringdb.db.get_bind(), 'before_cursor_execute',
+            lambda *args: statements.append(args[2]))
+
+    for command, expected, lines in [
+            (lambda: peeringdb.search('ripe'), 1, 5),
+            (lambda: peeringdb.info(3333), 1, 26),
+            (lambda: peeringdb.common(3333, 64500), 1, 24),
+            (lambda: peeringdb.all_possible(3333), 1, 14),
+            (lambda: peeringdb.contacts('ix'), 2, 24),
+            ]:
+        del statements[:]
+        peeringdb.db.expunge_all()
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            command()
+        finally:
+            stdout, sys.stdout = sys.stdout, stdout
+        eq_(expected, len(statements))
+        eq_(lines, len(stdout.getvalue().splitlines()))
+    peeringdb.db = None
+
+def test_ipindex():
+    peeringdb_fixture()
+    peeringdb.db.add_all([ peeringdb.Network(id=1, public=0, address='192.0.2.0/26'),
+        peeringdb.Network(id=2, public=1, address='2001:db8::/64'),
+        peeringdb.Network(id=3, public=2, address='not a prefix') ])
+    peeringdb.db.commit()
+    index = ipindex.IPIndex(peeringdb.load_addresses)
+    index.reload()
+    peeringdb.db = None
+
+    participant, exchange = index.lookup('192.0.2.4')
+    eq_((3333, 'RIPE NCC', 'IX1'), (participant.asn, participant.name, exchange))
+    eq_((None, 'IX0'), index.lookup('192.0.2.63'))
+    eq_((None, None), index.lookup('192.0.2.64'))
+    eq_((None, 'IX1'), index.lookup('2001:db8::ffff'))
+    eq_((None, None), index.lookup('bogus'))
+
+    peers = list(parsers.cisco_summary([ '192.0.2.1       4 64500  1 1 0 0 0 1w2d 10',
+        '192.0.2.4       4 64500  1 1 0 0 0 1w2d 10' ]))
+    eq_(False, index.annotate(peers[0])['asn_mismatch'])
+    eq_([ '192.0.2.4' ], [ p['ip'] for p in index.mismatches(peers) ])
+    eq_('Example', index.annotate(peers[0])['pdb_name'])
+
+def test_warm_start():
+    tmp = tempfile.mkdtemp()
+    try:
+        warm = warmstart.WarmStart(os.path.join(tmp, 'warm'))
+        handle = RouterHandle('juniper', 1, command=fake_command('juniper', '--peers', '6'))
+        router = RouterData(handle, PeerStore(warm=warm))
+        router.hardware_ttl = 3600
+        assert router.refresh()
+        hardware_time = router.hardware_time
+        assert router.refresh()
+        handle.close()
+        eq_(hardware_time, router.hardware_time)
+
+        restarted = RouterData(handle, PeerStore(warm=warm))
+        assert restarted.restore()
+        eq_((True, 'stale', router.updated), (restarted.stale, restarted.state, restarted.updated))
+        eq_(router.hardware, restarted.hardware)
+        eq_([ p._json() for p in router.peers ], [ p._json() for p in restarted.peers ])
+        assert not RouterData(RouterHandle('other', 1), PeerStore(warm=warm)).restore()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_fleet():
+    handles = [ RouterHandle(vendor, 1, 'secret', command=fake_command(vendor, '--peers', '4',
+        '--latency', '0.3')) for vendor in ('juniper', 'cisco', 'broken') ]
+    start = time.time()
+    results = list(fleet.run(handles, 'hardware', concurrency=3))
+    assert time.time() - start < 2, 'not in parallel'
+    eq_('broken', results[0]['host'])
+    assert results[0]['error'] and not results[0]['result']
+    eq_(set([ 'Juniper', 'Cisco' ]), set(r['result']['vendor'] for r in results[1:]))
+    assert all(r['seconds'] > 0.3 for r in results[1:])
+    table = fleet.table('hardware', results)
+    assert 'J8025' in table and 'broken' in table
+
+def test_peer_info_sessions():
+    handle = RouterHandle('juniper', 1, sessions=3, command=fake_command('juniper', '--latency', '0.2'))
+    sessions = [ handle.checkout() for i in range(3) ]
+    eq_(None, handle.checkout(wait=False))
+    for router in sessions:
+        handle.checkin(router)
+
+    start = time.time()
+    with handle as router:
+        info = router.peer_info('10.0.0.1')
+    assert time.time() - start < 0.8, 'not spread over the sessions'
+    eq_([ 'config', 'log', 'log2', 'ping', 'summary' ], sorted(info))
+    assert 'PING' in info['ping']
+    handle.close()
+
+    handle = RouterHandle('juniper', 1, sessions=3, command=fake_command('juniper'))
+    with handle as router:
+        router.peer_info('10.0.0.1')
+        eq_(None, handle.checkout(wait=False, idle_only=True))
+    eq_(1, handle.idle()) # no session opened to help
+    handle.close()
+
+def test_config_snapshot():
+    snapshot = confcache.ConfigSnapshot('\n'.join([
+        'router bgp 64496',
+        ' neighbor peers peer-group',
+        ' neighbor 2001:DB8:0::1 remote-as 64500',
+        ' neighbor 192.0.2.1 remote-as 64500',
+        ' neighbor 192.0.2.10 remote-as 64501',
+        ' address-family ipv6',
+        ' neighbor 2001:DB8::1 peer-group peers',
+    ]), group_re=r'^\s*neighbor (\S+) peer-group$', context_re=r'address-family')
+    eq_([ 'peers' ], snapshot.groups())
+    eq_([ ' neighbor 2001:DB8:0::1 remote-as 64500', ' address-family ipv6',
+        ' neighbor 2001:DB8::1 peer-group peers' ], snapshot.neighbor('2001:db8::1'))
+    eq_([ ' neighbor 192.0.2.1 remote-as 64500', ' address-family ipv6' ], snapshot.neighbor('192.0.2.1'))
+    eq_([], snapshot.neighbor('192.0.2.2'))
+
+def test_config_cache():
+    tmp = tempfile.mkdtemp()
+    try:
+        handle = RouterHandle('juniper', 1, command=fake_command('juniper', '--peers', '8'))
+        handle.config_cache = cache = confcache.ConfigCache('juniper', tmp)
+        with handle as router:
+            eq_('peers\npeers6', router.groups())
+            snapshot = cache.snapshot
+            info = router.peer_info('10.0.0.1')
+            eq_('set protocols bgp group peers neighbor 10.0.0.1 description "AS64513"\n'
+                'set protocols bgp group peers neighbor 10.0.0.1 peer-as 64513\n', info['config'])
+            cache._checked = 0
+            router.groups()
+            assert cache.snapshot is snapshot, 'fetched although the revision is the same'
+            restarted = confcache.ConfigCache('juniper', tmp).get(router)
+            eq_((snapshot.fingerprint, snapshot.fetched), (restarted.fingerprint, restarted.fetched))
+
+            router.apply_config('set system host-name fake')
+            router.groups()
+            assert cache.snapshot is not snapshot
+            assert cache.snapshot.revision != snapshot.revision
+        handle.close()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_ssh_multiplex():
+    handle = RouterHandle('router.example.net', 1, multiplex=True)
+    master = handle.master
+    eq_(0700, os.stat(os.path.dirname(master.path)).st_mode & 0777)
+    eq_([ 'ssh' ] + master.options() + [ '-oProtocol=2,1', 'router.example.net' ], handle.command)
+    assert not master.check()
+    open(master.path, 'w').close() # left behind by a dead master
+    assert not master.check()
+    assert not os.path.exists(master.path)
+    eq_(None, RouterHandle('juniper', 1, command=fake_command('juniper'), multiplex=True).master)
+
+def test_config_cache_waits_unlocked():
+    class Slow:
+        _config_cmd = 'show running-config'
+        _config_revision_cmd = None
+        _config_group_re = _config_context_re = None
+        cmds = []
+        def cmd(self, cmd):
+            self.cmds.append(cmd)
+            time.sleep(0.3)
+            return 'neighbor 192.0.2.1 remote-as 64500\n'
+
+    cache = confcache.ConfigCache('slow')
+    router = Slow()
+    threads = [ threading.Thread(target=cache.get, args=(router,)) for i in range(3) ]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    eq_(None, cache.snapshot)
+    cache.invalidate() # not blocked by the fetch
+    for t in threads:
+        t.join()
+    eq_(2, len(router.cmds)) # the first fetch was outdated by invalidate
+    eq_([ 'neighbor 192.0.2.1 remote-as 64500' ], cache.get(router).neighbor('192.0.2.1'))
+
+def test_ssh_multiplex_cisco():
+    class Master:
+        def __init__(self, path):
+            self.path = path
+        def ensure(self, password):
+            return os.path.exists(self.path)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for up in (False, True): # the first session logs in or finds the master
+            path = os.path.join(tmp, 'cisco')
+            if up:
+                open(path, 'w').close()
+            handle = RouterHandle('cisco', 1, 'secret', sessions=2,
+                    command=fake_command('cisco', '--master', path))
+            handle.master = Master(path)
+            sessions = [ handle.checkout(), handle.checkout() ]
+            eq_([ 'Cisco', 'Cisco' ], [ r.hardware()['vendor'] for r in sessions ])
+            for router in sessions:
+                handle.checkin(router)
+            handle.close()
+            os.unlink(path)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_ssh_master_start():
+    tmp = tempfile.mkdtemp()
+    try:
+        ssh = os.path.join(tmp, 'ssh')
+        with open(ssh, 'w') as f:
+            f.write("""#!/bin/sh
+for a; do case "$a" in -oControlPath=*) path=${a#-oControlPath=};; esac; done
+case "$1" in
+-O) [ "$2" = check ] && [ -e "$path" ] && exit 0
+    [ "$2" = exit ] && rm -f "$path" && exit 0
+    exit 255;;
+-fNM) printf 'Password: '; read pw; [ "$pw" = secret ] && touch "$path";;
+esac
+""")
+        os.chmod(ssh, 0755)
+        master = sshmux.ControlMaster('router.example.net')
+        master.ssh = ssh
+        assert not master.ensure('wrong')
+        assert not master.ensure('secret'), 'retried right away'
+        master._failed = 0
+        assert master.ensure('secret')
+        assert master.ensure(None) # up already, no login
+        master.exit()
+        assert not os.path.exists(master.path)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_until_prompt_long_line():
+    class Con:
+        timeout = 10
+        def __init__(self, data):
+            self.buffer = ''
+            self.chunks = [ data[i:i + 1000] for i in range(0, len(data), 1000) ]
+        def read_nonblocking(self, size, timeout):
+            return self.chunks.pop(0)
+
+    line = '{"x": "%s"}' % ('#' * 300000)
+    router = routers.Juniper()
+    router.con = Con('show x | json\n' + line + '\nrancid@fake> rest')
+    eq_('show x | json\n' + line, ''.join(router._until_prompt()))
+    eq_(' rest', router.con.buffer)
+
+    router = routers.Cisco()
+    router.con = Con('x' + line + '\nfake#')
+    eq_('x' + line, ''.join(router._until_prompt()))
+
+def test_peercli_fleet_ndjson():
+    tmp = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmp, 'config.py'), 'w') as f:
+            f.write('PUBKEY = ""\nROUTERS = %r\n' % [ (vendor, 1, 'secret', 1, None,
+                fake_command(vendor, '--peers', '4')) for vendor in ('juniper', 'cisco') ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ tmp, root ]))
+        peercli = subprocess.Popen([ sys.executable, os.path.join(root, 'bin', 'peercli'),
+            '--fleet', '.', '77777', 'hardware', '--format', 'ndjson' ],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = peercli.communicate()
+        eq_(0, peercli.returncode, err)
+        results = [ json.loads(line) for line in out.splitlines() ]
+        eq_([ 'cisco', 'juniper' ], sorted(r['host'] for r in results))
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,178 @@
+'''
+Timing of the phases of a router refresh
+
+A Trace is collected per refresh in the thread doing it. Code on the way
+marks its phases with span(), which costs nothing when no trace is being
+collected:
+
+    with trace.span('login'):
+        ...
+
+    with trace.collect('rrc00', timings):
+        router.peers()
+
+Spans of the same name are added up per router and per vendor by Timings,
+which can also append every trace to a file as a line of JSON.
+'''
+
+import json, logging, threading, time
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+class Span(object):
+    '''One timed phase; attrs can be added to while it runs'''
+    __slots__ = ('name', 'start', 'duration', 'attrs', 'trace')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = None
+
+    def add(self, key, value):
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.time() - self.start
+            self.trace.spans.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if value is not None:
+            self.attrs['error'] = value.__class__.__name__
+        self.finish()
+
+    def _json(self):
+        return dict(self.attrs, name=self.name,
+                start=round(self.start - self.trace.start, 6),
+                duration=round(self.duration, 6))
+
+class _NullSpan(object):
+    '''Stands in for a span when nothing is traced'''
+    def add(self, key, value):
+        pass
+
+    def finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_null = _NullSpan()
+
+class Trace:
+    '''The spans of one refresh of a router'''
+    def __init__(self, router):
+        self.router = router
+        self.vendor = None
+        self.start = time.time()
+        self.duration = None
+        self.attrs = {}
+        self.spans = []
+
+    def _json(self):
+        return {
+            'router': self.router,
+            'vendor': self.vendor,
+            'start': self.start,
+            'duration': self.duration,
+            'spans': [ s._json() for s in self.spans ],
+        }
+
+def current():
+    return getattr(_local, 'trace', None)
+
+def span(name, **attrs):
+    '''Start a span in the trace of this thread. Use it with "with" or call finish()'''
+    trace = current()
+    if trace is None:
+        return _null
+    return Span(trace, name, attrs)
+
+def set_vendor(vendor):
+    trace = current()
+    if trace is not None:
+        trace.vendor = vendor
+
+@contextmanager
+def collect(router, timings=None):
+    '''Trace what this thread does for router, and hand the trace to timings'''
+    trace = Trace(router)
+    previous, _local.trace = current(), trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+        trace.duration = time.time() - trace.start
+        if timings:
+            timings.add(trace)
+
+class _Stats:
+    '''count, total and max of the durations of a span, and the sums of its attrs'''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.attrs = {}
+
+    def add(self, span):
+        self.count += 1
+        self.total += span.duration
+        self.max = max(self.max, span.duration)
+        for key, value in span.attrs.items():
+            if isinstance(value, (int, long, float)):
+                self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def _json(self):
+        return dict(self.attrs, count=self.count, total=round(self.total, 6),
+                max=round(self.max, 6), mean=round(self.total / self.count, 6))
+
+class Timings:
+    '''Span statistics per router and per vendor, and the last trace of each router'''
+
+    def __init__(self, trace_file=None):
+        self.trace_file = trace_file
+        self._lock = threading.Lock()
+        self._routers = {}  # router -> { span name -> _Stats }
+        self._vendors = {}
+        self._last = {}
+
+    def add(self, trace):
+        with self._lock:
+            self._last[trace.router] = trace
+            for groups, key in ((self._routers, trace.router), (self._vendors, trace.vendor)):
+                stats = groups.setdefault(key, {})
+                stats.setdefault('refresh', _Stats()).add(trace)
+                for span in trace.spans:
+                    stats.setdefault(span.name, _Stats()).add(span)
+
+            if self.trace_file:
+                try:
+                    with open(self.trace_file, 'a') as f:
+                        f.write(json.dumps(trace._json(), separators=(',', ':')) + '\n')
+                except IOError, e:
+                    log.warn('cannot write trace: %s', e)
+
+    def _json(self, router=None):
+        with self._lock:
+            routers = [ router ] if router else sorted(self._routers)
+            return {
+                'routers': dict((r, {
+                    'vendor': self._last[r].vendor,
+                    'spans': dict((n, s._json()) for n, s in self._routers[r].items()),
+                    'last': self._last[r]._json(),
+                }) for r in routers if r in self._routers),
+                'vendors': dict((v, dict((n, s._json()) for n, s in stats.items()))
+                    for v, stats in self._vendors.items()),
+            }
@@ -2,11 +2,16 @@
 Misc Support Functions
 '''
 
-import json, signal, sys, traceback, cherrypy, logging, os
+import json, operator, signal, sys, traceback, cherrypy, logging, os
+import sshmux
 
 log = logging.getLogger(__name__)
 
-class Peer:
+class Peer(object):
+    '''One BGP session as seen by one router'''
+    __slots__ = ('ip', 'ver', 'asn', 'last_change', 'state', 'prefixes',
+            'afi', 'safi', 'router')
+
     def __init__(self):
         self.ip = None
         self.ver = None
@@ -14,9 +19,17 @@ class Peer:
         self.last_change = None
         self.state = None
         self.prefixes = None
+        self.afi = None  # ipv4, ipv6, ...
+        self.safi = None # unicast, multicast, ...
+        self.router = None
+
+    def _json(self):
+        return dict(zip(self.__slots__, _peer_fields(self)))
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self._json())
+
+_peer_fields = operator.attrgetter(*Peer.__slots__)
 
 def default(obj):
     try:
@@ -26,8 +39,11 @@ def default(obj):
     except AttributeError:
         return repr(obj)
 
-def encode(obj):
-    return json.dumps(obj, default=default, indent=4)
+def encode(obj, indent=4):
+    '''Pretty print by default. Without indent the much faster C encoder is used'''
+    if indent is None:
+        return json.dumps(obj, default=default, separators=(',', ':'))
+    return json.dumps(obj, default=default, indent=indent)
 
 def read_pass():
     '''Read a password from .password'''
@@ -74,6 +90,7 @@ def thread_dump(signum, frame):
 def exit():
     '''force exit because it is more user friendly'''
     log.warn('exiting')
+    sshmux.shutdown() # skipped by os._exit like all atexit functions
     os._exit(0)
 
 def register_signal_handlers():
@@ -0,0 +1,74 @@
+'''
+The last good refresh of every router, kept on disk for restarts
+
+Each successful refresh writes the peers, hardware and time of a router to
+a gzipped file of compact JSON of its own, so peerweb can show them right
+after a restart, marked stale until the router is refreshed again.
+'''
+
+import gzip, json, logging, os, re, tempfile
+
+from utils import Peer
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+def _str(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+class WarmStart:
+    '''A directory with a file per router'''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, router):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', router) + '.json.gz')
+
+    def save(self, router, peers, hardware, hardware_time, updated):
+        '''Replace the file of router, atomically'''
+        doc = {
+            'version': VERSION,
+            'updated': updated,
+            'hardware': hardware,
+            'hardware_time': hardware_time,
+            'fields': Peer.__slots__,
+            'peers': [ [ getattr(p, name) for name in Peer.__slots__ ] for p in peers ],
+        }
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.' + os.path.basename(self._file(router)))
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1, mtime=0) as f:
+                    f.write(json.dumps(doc, separators=(',', ':')))
+            os.rename(tmp, self._file(router))
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def load(self, router):
+        '''The saved dict of router with a list of utils.Peer, or None'''
+        try:
+            with gzip.open(self._file(router), 'rb') as f:
+                doc = json.loads(f.read())
+        except IOError:
+            return None
+        except ValueError, e:
+            log.warn('ignoring broken warm start file of %s: %s', router, e)
+            return None
+        if doc.get('version') != VERSION:
+            return None
+
+        fields = [ str(name) for name in doc['fields'] ]
+        peers = []
+        for values in doc['peers']:
+            peer = Peer()
+            for name, value in zip(fields, values):
+                if name in Peer.__slots__:
+                    setattr(peer, name, _str(value))
+            peers.append(peer)
+        doc['peers'] = peers
+        doc['hardware'] = dict((str(k), _str(v)) for k, v in doc['hardware'].items())
+        return doc
@@ -1,11 +1,15 @@
 '''
 Classes used by peerweb
 '''
-import logging, time
+import bisect, gzip, itertools, logging, netaddr, re, threading, time, zlib, Queue
 
+from collections import defaultdict, deque
+from cStringIO import StringIO
 from functools import wraps
 from cherrypy import serving, expose
-from utils import read_pass, encode
+from utils import Peer, read_pass, encode
+from events import EventLog
+import events, trace
 from routers import RouterHandle
 
 log = logging.getLogger(__name__)
@@ -16,40 +20,505 @@ def expose_json(func):
     def wrapper(*a, **kw):
         serving.response.headers['Content-Type'] = 'application/json'
         raw = func(*a, **kw)
-        return encode(raw)
+        return encode(raw, indent=None)
 
     return expose(wrapper)
 
+def _gzip(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+def fan_out(items, func, concurrency=10, timeout=30):
+    '''
+    Run func(item) for every item in threads, at most concurrency at once,
+    and yield (item, result, error) in the order they finish. An item still
+    running after timeout seconds is given up with the error 'timeout' and
+    no longer counts against the concurrency; its thread is left to finish
+    on its own.
+    '''
+    pending = list(reversed(items))
+    done = Queue.Queue()
+    running = {}  # index -> (item, started)
+
+    def run(i, item):
+        try:
+            done.put((i, func(item), None))
+        except Exception, e:
+            log.info('%s failed: %s', item, e)
+            done.put((i, None, '%s: %s' % (e.__class__.__name__, e)))
+
+    def start():
+        item = pending.pop()
+        i = len(items) - len(pending) - 1
+        running[i] = (item, time.time())
+        t = threading.Thread(target=run, args=(i, item))
+        t.daemon = True
+        t.start()
+
+    while pending or running:
+        while pending and len(running) < concurrency:
+            start()
+
+        first = min(started for item, started in running.values())
+        try:
+            i, result, error = done.get(timeout=max(0, first + timeout - time.time()))
+        except Queue.Empty:
+            now = time.time()
+            for i, (item, started) in running.items():
+                if started + timeout <= now:
+                    del running[i]
+                    yield item, None, 'timeout'
+            continue
+
+        if i in running: # else it was given up already
+            item = running.pop(i)[0]
+            yield item, result, error
+
+class Snapshot:
+    '''
+    Compact JSON of { "data": [ ... ] } kept ready to serve
+
+    Every key, e.g. a router name, owns a serialised fragment of the list
+    which is only rebuilt when that key is updated. Responses are cached
+    per set of keys until one of them changes, and carry an ETag naming
+    that version.
+    '''
+    def __init__(self, compress=True, keep=64):
+        self.compress = compress
+        self.keep = keep
+        self.version = 0
+        self._epoch = int(time.time())
+        self._fragments = {}
+        self._versions = {}
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, items):
+        fragment = encode(list(items), indent=None)[1:-1]
+        with self._lock:
+            self.version += 1
+            self._fragments[key] = fragment
+            self._versions[key] = self.version
+
+    def render(self, keys):
+        '''Return (etag, body, gzipped body or None) for the fragments of keys'''
+        keys = tuple(keys)
+        with self._lock:
+            version = max([ self._versions.get(k, 0) for k in keys ] or [ 0 ])
+            cached = self._rendered.get(keys)
+            if cached and cached[0] == version:
+                return cached[1]
+            fragments = [ self._fragments[k] for k in keys if self._fragments.get(k) ]
+
+        body = '{"data":[%s]}' % ','.join(fragments)
+        etag = '"%x-%x-%d"' % (self._epoch, zlib.crc32(repr(keys)) & 0xffffffff, version)
+        result = (etag, body, _gzip(body) if self.compress else None)
+
+        with self._lock:
+            if len(self._rendered) >= self.keep:
+                self._rendered.clear()
+            self._rendered[keys] = (version, result)
+        return result
+
+def serve_snapshot(snapshot, keys):
+    '''Answer the current request from snapshot, with a 304 if the client has it'''
+    etag, body, gzipped = snapshot.render(keys)
+    request, response = serving.request, serving.response
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+
+    matches = [ t.strip() for t in request.headers.get('If-None-Match', '').split(',') ]
+    if etag in matches or '*' in matches:
+        response.status = 304
+        return ''
+
+    if gzipped and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response.headers['Content-Encoding'] = 'gzip'
+        return gzipped
+    return body
+
+class ChangeLog:
+    '''
+    Numbered changes for clients following peerweb live
+
+    Clients remember the sequence number of the last change they saw and
+    ask for everything after it. If that has dropped out of the buffer, or
+    is from before a restart, they are told to reload instead.
+    '''
+    def __init__(self, size=10000):
+        self.seq = 0
+        self._changes = deque(maxlen=size)
+        self._cond = threading.Condition()
+
+    def append(self, type, **data):
+        with self._cond:
+            self.seq += 1
+            data.update(seq=self.seq, type=type, time=time.time() * 1000)
+            self._changes.append(data)
+            self._cond.notify_all()
+        return data['seq']
+
+    def since(self, seq):
+        '''Return (changes after seq, reset), reset meaning seq is unknown'''
+        with self._cond:
+            if seq > self.seq or (self._changes and seq < self._changes[0]['seq'] - 1):
+                return [], True
+            if seq == self.seq:
+                return [], False
+            return [ c for c in self._changes if c['seq'] > seq ], False
+
+    def wait(self, seq, timeout):
+        '''Like since, but block up to timeout seconds for a change after seq'''
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.seq == seq:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+        return self.since(seq)
+
+def _ip_key(ip):
+    '''Sort key of an address: all of IPv4 before IPv6, then numerically'''
+    try:
+        addr = netaddr.IPAddress(ip)
+        return (addr.version, addr.value)
+    except (netaddr.AddrFormatError, TypeError, ValueError):
+        return (0, ip)
+
+class RouterIndex:
+    '''Lookups by ASN, state and address into the peers of one router'''
+    def __init__(self, peers):
+        self.peers = peers
+        self.asn = defaultdict(list)
+        self.state = defaultdict(list)
+        for peer in peers:
+            self.asn[peer.asn].append(peer)
+            self.state[(peer.state or '').lower()].append(peer)
+
+        keyed = sorted((_ip_key(peer.ip), i) for i, peer in enumerate(peers))
+        self.ips = [ key for key, i in keyed ]
+        self.by_ip = [ peers[i] for key, i in keyed ]
+
+    def prefix(self, net):
+        '''Peers with an address in the netaddr.IPNetwork net'''
+        lo = bisect.bisect_left(self.ips, (net.version, net.first))
+        hi = bisect.bisect_right(self.ips, (net.version, net.last))
+        return self.by_ip[lo:hi]
+
+_asn_term = re.compile('^(?:as)?(\d+)$', re.IGNORECASE)
+
+class PeerStore:
+    '''
+    The peers of every router, replaced a router at a time
+
+    Values repeated across the fleet are interned, so 100k sessions share
+    a handful of state, family and router name strings and ASN ints.
+    '''
+    _interned = ('state', 'asn', 'afi', 'safi', 'router')
+
+    def __init__(self, snapshot=None, changes=None, history=None, events=None,
+            prefix_delta=100, metrics=None, timings=None, warm=None):
+        self._routers = {}
+        self._indexes = {}
+        self._sorted = {}
+        self._states = set()
+        self._values = {}
+        self.snapshot = snapshot or Snapshot()
+        self.changes = changes or ChangeLog()
+        self.history = history # a history.History to record refreshes in
+        self.events = events or EventLog()
+        self.prefix_delta = prefix_delta
+        self.metrics = metrics # a metrics.Metrics to publish sessions to
+        self.timings = timings # a trace.Timings collecting the phases of refreshes
+        self.warm = warm # a warmstart.WarmStart saving the last good refresh of each router
+
+    def replace(self, router, peers):
+        values = self._values
+        for peer in peers:
+            peer.router = router
+            for name in self._interned:
+                value = getattr(peer, name)
+                setattr(peer, name, values.setdefault(value, value))
+
+        if router in self._routers:
+            changes = events.diff(router, self._routers[router], peers, self.prefix_delta)
+            self.events.publish(changes)
+            for event in changes:
+                self.changes.append('event', event=event)
+
+        if self.history:
+            try:
+                self.history.record(router, peers)
+            except Exception:
+                log.error('error recording history of %s', router, exc_info=True)
+
+        if self.metrics:
+            self.metrics.sessions(router, peers)
+
+        self._routers[router] = tuple(peers)
+        self._indexes[router] = RouterIndex(self._routers[router])
+        self._states.update(self._indexes[router].state)
+        self.snapshot.update(router, self._routers[router])
+
+    def get(self, router):
+        return self._routers.get(router, ())
+
+    def all(self, routers=None):
+        '''Every peer, or those of the named routers'''
+        if routers is None:
+            routers = sorted(self._routers)
+        return list(itertools.chain.from_iterable(self.get(r) for r in routers))
+
+    def __len__(self):
+        return sum(len(peers) for peers in self._routers.values())
+
+    def _conditions(self, search, columns):
+        '''
+        Turn the search box and per column searches into (field, value)
+        pairs. Search terms are read as an ASN ("AS3333" or "3333"), an
+        address or prefix, a state, a router name or else a substring of
+        any of these.
+        '''
+        conditions = []
+        for term in search.split():
+            m = _asn_term.match(term)
+            if m:
+                conditions.append(('asn', int(m.group(1))))
+            elif term in self._routers:
+                conditions.append(('router', term))
+            elif _network(term):
+                conditions.append(('ip', _network(term)))
+            elif term.lower() in self._states:
+                conditions.append(('state', term.lower()))
+            else:
+                conditions.append(('text', term.lower()))
+
+        for field, term in columns.items():
+            if field == 'asn' and _asn_term.match(term):
+                conditions.append(('asn', int(_asn_term.match(term).group(1))))
+            elif field == 'ip' and _network(term):
+                conditions.append(('ip', _network(term)))
+            elif field in ('router', 'state'):
+                conditions.append((field, term if field == 'router' else term.lower()))
+            elif field in Peer.__slots__:
+                conditions.append(('field', (field, term.lower())))
+        return conditions
+
+    def _match(self, router, conditions):
+        '''Peers of router meeting all conditions, looking up the first indexed one'''
+        index = self._indexes.get(router)
+        if not index:
+            return []
+
+        rest = []
+        peers = None
+        for field, value in conditions:
+            if field == 'router':
+                if value != router:
+                    return []
+            elif peers is None and field == 'ip':
+                peers = index.prefix(value)
+            elif peers is None and field in ('asn', 'state'):
+                peers = getattr(index, field).get(value, [])
+            else:
+                rest.append((field, value))
+        if peers is None:
+            peers = index.peers
+
+        for field, value in rest:
+            if field == 'ip':
+                keys = _KeyRange(value)
+                peers = [ p for p in peers if _ip_key(p.ip) in keys ]
+            elif field == 'asn':
+                peers = [ p for p in peers if p.asn == value ]
+            elif field == 'state':
+                peers = [ p for p in peers if (p.state or '').lower() == value ]
+            elif field == 'field':
+                name, text = value
+                peers = [ p for p in peers if text in str(getattr(p, name)).lower() ]
+            else:
+                peers = [ p for p in peers if value in p.ip.lower()
+                    or value in p.router.lower() or value in (p.state or '').lower()
+                    or value in str(p.asn) ]
+        return peers
+
+    def query(self, routers, search='', columns={}, sort=None, reverse=False,
+            start=0, length=None):
+        '''
+        Filter, sort and page the peers of the named routers. columns maps a
+        field to the text to search it for. Returns the number of peers, the
+        number matching and the requested page of them.
+        '''
+        routers = tuple(routers)
+        total = sum(len(self.get(r)) for r in routers)
+        conditions = self._conditions(search, columns)
+
+        if conditions:
+            peers = []
+            for router in routers:
+                peers += self._match(router, conditions)
+            if sort in Peer.__slots__:
+                peers.sort(key=_sort_key(sort), reverse=reverse)
+            reverse = False
+        elif sort in Peer.__slots__:
+            peers = self._sorted_all(routers, sort)
+        else:
+            end = None if length is None or length < 0 else start + length
+            return total, total, self._slice(routers, start, end)
+
+        count = len(peers)
+        end = count if length is None or length < 0 else min(count, start + length)
+        if reverse:
+            # walk the cached ascending order backwards instead of copying it
+            page = peers[max(0, count - end):max(0, count - start)][::-1]
+        else:
+            page = peers[start:end]
+        return total, count, page
+
+    def _slice(self, routers, start, end):
+        '''all(routers)[start:end] without building all of it'''
+        page = []
+        for router in routers:
+            peers = self.get(router)
+            if end is not None and end <= 0:
+                break
+            if start < len(peers):
+                page += peers[start:end]
+            start = max(0, start - len(peers))
+            if end is not None:
+                end -= len(peers)
+        return page
+
+    def _sorted_all(self, routers, field):
+        '''All peers of routers sorted by field, cached until the next refresh'''
+        key = (routers, field)
+        version = self.snapshot.version
+        cached = self._sorted.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        peers = sorted(self.all(routers), key=_sort_key(field))
+        if len(self._sorted) > 16:
+            self._sorted.clear()
+        self._sorted[key] = (version, peers)
+        return peers
+
+class _KeyRange:
+    '''Membership test of an _ip_key in a netaddr.IPNetwork'''
+    def __init__(self, net):
+        self.net = net
+
+    def __contains__(self, key):
+        return key[0] == self.net.version and self.net.first <= key[1] <= self.net.last
+
+def _network(term):
+    '''A complete address or prefix as IPNetwork, partial ones are searched as text'''
+    addr = term.split('/')[0]
+    if not (netaddr.valid_ipv4(addr, netaddr.INET_PTON) or netaddr.valid_ipv6(addr)):
+        return None
+    try:
+        return netaddr.IPNetwork(term)
+    except (netaddr.AddrFormatError, ValueError, TypeError):
+        return None
+
+def _sort_key(field):
+    if field == 'ip':
+        return lambda peer: _ip_key(peer.ip)
+    return lambda peer: getattr(peer, field)
+
 class RouterData:
     '''Hold the cached results'''
-    def __init__(self, handle):
+    def __init__(self, handle, store=None, status=None):
         self.name = handle.host.replace('.ripe.net', '').replace('router.', '')
-        self.state = 'uninitiated'
         self.updated = 0
-        self.peers = []
+        self.store = store if store is not None else PeerStore()
+        self.status = status # Snapshot of the _json of every router
         self.hardware = dict(vendor=None, model=None, serial=None)
+        self.hardware_time = 0
+        self.hardware_ttl = 0 # seconds before the hardware is fetched again
         self.handle = handle
+        self.interval = None # seconds between refreshes, None for the default
+        self.stale = False # showing what was saved before a restart
+        self._lock = threading.Lock()
+        self.set_state('uninitiated')
+
+    def set_state(self, state):
+        '''Change the state and publish it to the status snapshot'''
+        self.state = state
+        if self.status:
+            self.status.update(self.name, [ self ])
+        self.store.changes.append('router', router=self._json())
 
     def refresh(self):
-        self.state = 'refreshing'
+        '''Fetch peers and hardware from the router. Returns True on success'''
+        self.set_state('refreshing')
 
         try:
             start = time.time()
 
-            with self.handle as con:
-                self.peers = con.peers()
-                for peer in self.peers:
-                    peer.router = self.name
-                self.hardware = con.hardware()
+            with trace.collect(self.name, self.store.timings):
+                with self.handle as con:
+                    peers = con.peers()
+                    if time.time() - self.hardware_time >= self.hardware_ttl:
+                        self.hardware = con.hardware()
+                        self.hardware_time = time.time()
+                with trace.span('store'):
+                    with self._lock:
+                        self.store.replace(self.name, peers)
+                        self.updated = time.time() * 1000;
+                        self.stale = False
+                if self.store.warm:
+                    with trace.span('warm'):
+                        self._save(peers)
             
-            self.updated = time.time() * 1000;
-            self.state = 'ok in %.1fs' % (
+            self.set_state('ok in %.1fs' % (
                 time.time() - start
-                )
+                ))
             log.info('%s: %s', self.name, self.state)
+            self._refreshed(start, None)
+            return True
         except Exception, e:
-            self.state = 'error: %s' % e.__class__.__name__
+            self.set_state('error: %s' % e.__class__.__name__)
             log.error('error updating %s', self.name, exc_info=True)
+            self._refreshed(start, e.__class__.__name__)
+            return False
+
+    def _save(self, peers):
+        try:
+            self.store.warm.save(self.name, peers, self.hardware, self.hardware_time, self.updated)
+        except Exception:
+            log.error('error saving %s for a warm start', self.name, exc_info=True)
+
+    def restore(self):
+        '''Show what was saved by the last good refresh until the next one. Returns True if found'''
+        saved = self.store.warm and self.store.warm.load(self.name)
+        if not saved:
+            return False
+        with self._lock:
+            if self.updated: # refreshed already
+                return False
+            self.store.replace(self.name, saved['peers'])
+            self.hardware = saved['hardware']
+            self.hardware_time = saved['hardware_time']
+            self.updated = saved['updated']
+            self.stale = True
+        self.set_state('stale')
+        return True
+
+    def _refreshed(self, start, error):
+        now = time.time()
+        self.store.changes.append('refresh', router=self.name, ok=not error)
+        if self.store.metrics:
+            self.store.metrics.refreshed(self.name, now - start, not error, error, now)
+
+    @property
+    def peers(self):
+        return self.store.get(self.name)
 
     def _json(self):
         return {
@@ -59,5 +528,6 @@ class RouterData:
             'state': self.state,
             'peers': len(self.peers),
             'hardware': self.hardware,
+            'stale': self.stale,
             'error': self.handle.error,
         }
@@ -12,7 +12,7 @@ setup(
     packages = find_packages(),
     zip_safe = False,
     package_data = {
-        '': [ 'static/*.*', 'static/images/*.*' ]
+        '': [ 'static/*.*', 'static/images/*.*', 'fixtures/*.*' ]
     },
     install_requires = [
         'netaddr',
@@ -27,5 +27,6 @@ setup(
         'bin/peercli',
         'bin/peerweb',
         'bin/peerdbcli',
+        'bin/peerbench',
     ],
 )